@@ -0,0 +1,51 @@
+"""
+Micro-benchmark for the function resolution in `nnfabrik.builder.resolve_fn`.
+
+Every key made during a populate of a TrainedModel table resolves the model, dataset and trainer functions
+(via `get_model`, `get_data` and `get_trainer`). This script measures the time spent on these resolutions for
+a populate over 10,000 keys, with and without the resolution cache.
+
+Usage:
+    python benchmarks/resolve_fn.py [--keys 10000]
+"""
+import argparse
+import timeit
+
+from nnfabrik.builder import resolve_cache, resolve_model, resolve_data, resolve_trainer
+
+
+FUNCTIONS = (
+    (resolve_model, "nnfabrik.examples.mnist.model.mnist_model_fn"),
+    (resolve_data, "nnfabrik.examples.mnist.dataset.mnist_dataset_fn"),
+    (resolve_trainer, "nnfabrik.examples.mnist.trainer.mnist_trainer_fn"),
+)
+
+
+def resolve_all():
+    for resolver, fn_name in FUNCTIONS:
+        resolver(fn_name)
+
+
+def run(n_keys, cached):
+    resolve_cache.clear()
+    resolve_cache.enabled = cached
+    resolve_all()  # make sure all modules are imported before timing
+    try:
+        return timeit.timeit(resolve_all, number=n_keys)
+    finally:
+        resolve_cache.enabled = True
+        resolve_cache.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=10000, help="number of keys made during the simulated populate")
+    args = parser.parse_args()
+
+    uncached = run(args.keys, cached=False)
+    cached = run(args.keys, cached=True)
+
+    print("Resolution cost for a populate over {} keys ({} resolutions per key)".format(args.keys, len(FUNCTIONS)))
+    print("  without cache: {:8.2f} ms ({:.2f} us per key)".format(uncached * 1e3, uncached / args.keys * 1e6))
+    print("  with cache:    {:8.2f} ms ({:.2f} us per key)".format(cached * 1e3, cached / args.keys * 1e6))
+    print("  speed-up:      {:8.1f}x".format(uncached / cached))
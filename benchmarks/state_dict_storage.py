@@ -0,0 +1,95 @@
+"""
+Benchmark for the storage options of the state_dicts of trained models (see `nnfabrik.utility.storage`).
+
+For every combination of the reduced precision (`state_dict_dtype` of a TrainedModel table) and the compression
+(`state_dict_compression`), this script saves a synthetic state_dict the way `TrainedModelBase.save_state_dict` does,
+and reports the size of the file relative to the default storage, as well as the time to save and to load it
+(including decompression and the upcast to the original dtypes). Compressions whose packages are not installed
+are skipped.
+
+Note that random weights compress worse than the weights of most trained models.
+
+Usage:
+    python benchmarks/state_dict_storage.py [--megabytes 100] [--format torch] [--repeats 3]
+"""
+import argparse
+import os
+import tempfile
+import timeit
+from collections import OrderedDict
+
+import torch
+
+from nnfabrik.utility.storage import (
+    COMPRESSIONS,
+    STATE_DICT_FORMATS,
+    load_state_dict_file,
+    save_state_dict_file,
+    state_dict_filename,
+)
+
+
+def make_state_dict(megabytes):
+    """A state_dict of float32 tensors, about `megabytes` in size, with the layer sizes of a small conv net."""
+    state_dict = OrderedDict()
+    n_params, layer = 0, 0
+    while n_params * 4 < megabytes * 2 ** 20:
+        state_dict["core.layer{}.weight".format(layer)] = torch.randn(256, 256, 3, 3)
+        state_dict["core.layer{}.bias".format(layer)] = torch.randn(256)
+        state_dict["core.layer{}.num_batches_tracked".format(layer)] = torch.tensor(100)
+        n_params += 256 * 256 * 9 + 256
+        layer += 1
+    return state_dict
+
+
+def available(compression):
+    if compression is None or compression == "gzip":
+        return True
+    try:
+        __import__({"zstd": "zstandard", "lz4": "lz4.frame"}[compression])
+        return True
+    except ImportError:
+        return False
+
+
+def run(state_dict, format, dtype, compression, repeats):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filepath = os.path.join(temp_dir, state_dict_filename("state_dict", format, compression))
+
+        def save():
+            save_state_dict_file(state_dict, filepath, format=format, dtype=dtype, compression=compression)
+
+        def load():
+            loaded = load_state_dict_file(filepath)
+            # make sure lazily loaded tensors are actually read
+            for tensor in loaded.values():
+                tensor.sum()
+
+        save_time = min(timeit.repeat(save, number=1, repeat=repeats))
+        load_time = min(timeit.repeat(load, number=1, repeat=repeats))
+        return os.path.getsize(filepath), save_time, load_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=float, default=100, help="size of the state_dict at full precision")
+    parser.add_argument("--format", default="torch", choices=list(STATE_DICT_FORMATS), help="state_dict format")
+    parser.add_argument("--repeats", type=int, default=3, help="repetitions per measurement (the fastest counts)")
+    args = parser.parse_args()
+
+    state_dict = make_state_dict(args.megabytes)
+    baseline = None
+
+    print("{:<10} {:<8} {:>10} {:>8} {:>10} {:>10}".format("dtype", "compr.", "size [MB]", "ratio", "save [s]", "load [s]"))
+    for dtype in (None, "float16", "bfloat16"):
+        for compression in (None,) + tuple(COMPRESSIONS):
+            if not available(compression):
+                continue
+            size, save_time, load_time = run(state_dict, args.format, dtype, compression, args.repeats)
+            if baseline is None:
+                baseline = size
+            print(
+                "{:<10} {:<8} {:>10.1f} {:>7.2f}x {:>10.3f} {:>10.3f}".format(
+                    dtype or "-", compression or "-", size / 2 ** 20, baseline / size, save_time, load_time
+                )
+            )
@@ -1,32 +1,108 @@
 from . import utility
+import sys
 from functools import partial
+from importlib import import_module
 
-from .utility.nnf_helper import split_module_name, dynamic_import
+from .utility.nnf_helper import split_module_name
 from .utility.nn_helpers import load_state_dict
 
 
+class ResolveCache:
+    """
+    Cache for the objects resolved by `resolve_fn`, keyed by `(fn_name, default_base)`.
+
+    If `watch_reloads` is True, the attribute is looked up again in the (cached) module on every access,
+    so that functions redefined by `importlib.reload` are picked up, while the import itself is still skipped.
+    Entries whose module was replaced in `sys.modules` are resolved from scratch.
+    Use `clear` to invalidate all or selected entries explicitly.
+    """
+
+    def __init__(self, watch_reloads=False):
+        self.enabled = True
+        self.watch_reloads = watch_reloads
+        self._entries = {}
+
+    def get(self, fn_name, default_base):
+        entry = self._entries.get((fn_name, default_base))
+        if entry is None:
+            return None
+        module, name, fn_obj = entry
+        if self.watch_reloads:
+            module_name = getattr(module, "__name__", None)
+            if module_name in sys.modules and sys.modules[module_name] is not module:
+                del self._entries[(fn_name, default_base)]
+                return None
+            fn_obj = getattr(module, name, None)
+            if fn_obj is None or not callable(fn_obj):
+                # the object disappeared with a reload, so resolve it from scratch
+                del self._entries[(fn_name, default_base)]
+                return None
+            self._entries[(fn_name, default_base)] = (module, name, fn_obj)
+        return fn_obj
+
+    def set(self, fn_name, default_base, module, name, fn_obj):
+        if self.enabled:
+            self._entries[(fn_name, default_base)] = (module, name, fn_obj)
+
+    def clear(self, fn_name=None, default_base=None):
+        """
+        Removes entries from the cache. If neither `fn_name` nor `default_base` are given, the whole cache is
+        cleared. Otherwise, only entries matching the given values are removed.
+        """
+        if fn_name is None and default_base is None:
+            self._entries.clear()
+            return
+        for cached_name, cached_base in list(self._entries):
+            if fn_name is not None and cached_name != fn_name:
+                continue
+            if default_base is not None and cached_base != default_base:
+                continue
+            del self._entries[(cached_name, cached_base)]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+resolve_cache = ResolveCache()
+
+
 def resolve_fn(fn_name, default_base):
     """
     Given a string `fn_name`, resolves the name into a callable object. If the name has multiple `.` separated parts, treat all but the last
-    as module names to trace down to the final name. If just the name is given, tries to resolve the name in the `default_base` module name context
-    with direct eval of `{default_base}.{fn_name}` in this function's context.
+    as module names to trace down to the final name. If just the name is given, tries to resolve the name as an attribute of the
+    object named `default_base` in this module's context.
 
     Raises `NameError` if no object matching the name is found and `TypeError` if the resolved object is not callabe.
 
+    Successfully resolved objects are cached in `resolve_cache`, such that subsequent calls with the same arguments are cheap.
+
     When successful, returns the resolved, callable object.
     """
+    fn_obj = resolve_cache.get(fn_name, default_base)
+    if fn_obj is not None:
+        return fn_obj
+
     module_path, class_name = split_module_name(fn_name)
 
+    if module_path:
+        module = import_module(module_path)
+    else:
+        module = globals().get(default_base)
+        if module is None:
+            raise NameError("Function `{}` does not exist".format(class_name))
+
     try:
-        fn_obj = (
-            dynamic_import(module_path, class_name) if module_path else eval("{}.{}".format(default_base, class_name))
-        )
-    except NameError:
+        fn_obj = getattr(module, class_name)
+    except AttributeError:
+        if module_path:
+            raise
         raise NameError("Function `{}` does not exist".format(class_name))
 
     if not callable(fn_obj):
         raise TypeError("The object named {} is not callable.".format(class_name))
 
+    resolve_cache.set(fn_name, default_base, module, class_name, fn_obj)
+
     return fn_obj
 
 
@@ -43,6 +43,74 @@ class Fabrikant(dj.Manual):
             return entry.fetch1("fabrikant_name")
 
 
+def _add_entries(table, prefix, resolver, fn, configs, fabrikant=None, comment="", skip_duplicates=False):
+    """
+    Adds multiple entries that share the same function `fn` to `table` (one of Model, Dataset or Trainer)
+    in bulk. The function is resolved and the fabrikant is looked up only once, all existing entries are
+    found with a single query, and all new entries are inserted with a single multi-row insert.
+
+    Args:
+        table - table instance to add the entries to
+        prefix (string) - prefix of the attribute names, i.e. one of "model", "dataset" or "trainer"
+        resolver - function that resolves the name `fn` into a callable object
+        fn (string) - name of the function shared by all entries
+        configs (iterable) - configuration objects, one per entry
+        fabrikant (string) - the fabrikant name. If None, it is resolved based on the current database user.
+        comment (string) - comment for all entries
+        skip_duplicates (bool) - If True, no error is thrown when some of the entries already exist
+
+    Returns:
+        keys - list of keys in the table corresponding to the configs, in the same order as `configs`.
+    """
+    try:
+        resolver(fn)
+    except (NameError, TypeError) as e:
+        warnings.warn(str(e) + "\nTable entries rejected")
+        return
+
+    if fabrikant is None:
+        fabrikant = Fabrikant.get_current_user()
+
+    fn_attr, hash_attr, config_attr = prefix + "_fn", prefix + "_hash", prefix + "_config"
+
+    configs = list(configs)
+    hashes = [make_hash(config) for config in configs]
+    if not hashes:
+        return []
+
+    unique_hashes = list(dict.fromkeys(hashes))
+    existing = table & [{fn_attr: fn, hash_attr: h} for h in unique_hashes]
+    # the configs are not fetched, as they are identical to the given ones with the same hash
+    existing = existing.proj(*[attr for attr in table.heading.non_blobs if attr not in table.primary_key])
+    existing = {entry[hash_attr]: entry for entry in existing.fetch(as_dict=True)}
+
+    if existing:
+        if skip_duplicates:
+            warnings.warn("{} corresponding entries found. Skipping...".format(len(existing)))
+        else:
+            raise ValueError("{} corresponding entries already exist".format(len(existing)))
+
+    new_entries = {}
+    for entry_hash, config in zip(hashes, configs):
+        if entry_hash in existing or entry_hash in new_entries:
+            continue
+        new_entries[entry_hash] = {
+            fn_attr: fn,
+            hash_attr: entry_hash,
+            config_attr: config,
+            prefix + "_fabrikant": fabrikant,
+            prefix + "_comment": comment,
+        }
+
+    if new_entries:
+        table.insert(list(new_entries.values()))
+
+    return [
+        dict(existing[h], **{config_attr: config}) if h in existing else new_entries[h]
+        for h, config in zip(hashes, configs)
+    ]
+
+
 @schema
 class Model(dj.Manual):
     definition = """
@@ -117,6 +185,42 @@ class Model(dj.Manual):
 
         return key
 
+    def add_entries(
+        self,
+        model_fn,
+        model_configs,
+        model_fabrikant=None,
+        model_comment="",
+        skip_duplicates=False,
+    ):
+        """
+        Add multiple new entries sharing the same model_fn to the model table in bulk. This is much faster than
+        calling `add_entry` in a loop, since the database is only queried once for existing entries and all
+        new entries are inserted at once.
+
+        Args:
+            model_fn (string) - name of a callable object, resolved as in `add_entry`.
+            model_configs (list) - list of Python dictionaries containing keyword arguments for the model_fn, one per entry
+            model_fabrikant (string) - The fabrikant name. Must match an existing entry in Fabrikant table. If ignored, will attempt to resolve Fabrikant based
+                on the database user name for the existing connection.
+            model_comment - Optional comment for all entries.
+            skip_duplicates - If True, no error is thrown when some of the entries already exist.
+
+        Returns:
+            keys - list of keys in the table corresponding to the new (or possibly existing, if skip_duplicates=True) entries,
+                in the same order as model_configs.
+        """
+        return _add_entries(
+            self,
+            "model",
+            resolve_model,
+            model_fn,
+            model_configs,
+            fabrikant=model_fabrikant,
+            comment=model_comment,
+            skip_duplicates=skip_duplicates,
+        )
+
     def build_model(self, dataloaders=None, seed=None, key=None, data_info=None):
         """
         Builds a Pytorch module by calling the model_fn with the corresponding model_config. The table has to be
@@ -229,6 +333,42 @@ class Dataset(dj.Manual):
 
         return key
 
+    def add_entries(
+        self,
+        dataset_fn,
+        dataset_configs,
+        dataset_fabrikant=None,
+        dataset_comment="",
+        skip_duplicates=False,
+    ):
+        """
+        Add multiple new entries sharing the same dataset_fn to the dataset table in bulk. This is much faster than
+        calling `add_entry` in a loop, since the database is only queried once for existing entries and all
+        new entries are inserted at once.
+
+        Args:
+            dataset_fn (string) - name of a callable object, resolved as in `add_entry`.
+            dataset_configs (list) - list of Python dictionaries containing keyword arguments for the dataset_fn, one per entry
+            dataset_fabrikant (string) - The fabrikant name. Must match an existing entry in Fabrikant table. If ignored, will attempt to resolve Fabrikant based
+                on the database user name for the existing connection.
+            dataset_comment - Optional comment for all entries.
+            skip_duplicates - If True, no error is thrown when some of the entries already exist.
+
+        Returns:
+            keys - list of keys in the table corresponding to the new (or possibly existing, if skip_duplicates=True) entries,
+                in the same order as dataset_configs.
+        """
+        return _add_entries(
+            self,
+            "dataset",
+            resolve_data,
+            dataset_fn,
+            dataset_configs,
+            fabrikant=dataset_fabrikant,
+            comment=dataset_comment,
+            skip_duplicates=skip_duplicates,
+        )
+
     def get_dataloader(self, seed=None, key=None):
         """
         Returns a dataloader for a given dataset loader function and its corresponding configurations
@@ -332,6 +472,42 @@ class Trainer(dj.Manual):
 
         return key
 
+    def add_entries(
+        self,
+        trainer_fn,
+        trainer_configs,
+        trainer_fabrikant=None,
+        trainer_comment="",
+        skip_duplicates=False,
+    ):
+        """
+        Add multiple new entries sharing the same trainer_fn to the trainer table in bulk. This is much faster than
+        calling `add_entry` in a loop, since the database is only queried once for existing entries and all
+        new entries are inserted at once.
+
+        Args:
+            trainer_fn (string) - name of a callable object, resolved as in `add_entry`.
+            trainer_configs (list) - list of Python dictionaries containing keyword arguments for the trainer_fn, one per entry
+            trainer_fabrikant (string) - The fabrikant name. Must match an existing entry in Fabrikant table. If ignored, will attempt to resolve Fabrikant based
+                on the database user name for the existing connection.
+            trainer_comment - Optional comment for all entries.
+            skip_duplicates - If True, no error is thrown when some of the entries already exist.
+
+        Returns:
+            keys - list of keys in the table corresponding to the new (or possibly existing, if skip_duplicates=True) entries,
+                in the same order as trainer_configs.
+        """
+        return _add_entries(
+            self,
+            "trainer",
+            resolve_trainer,
+            trainer_fn,
+            trainer_configs,
+            fabrikant=trainer_fabrikant,
+            comment=trainer_comment,
+            skip_duplicates=skip_duplicates,
+        )
+
     def get_trainer(self, key=None, build_partial=True):
         """
         Returns the trainer function and its corresponding configurations. If build_partial=True (default), then it constructs
@@ -1,4 +1,7 @@
 from .trained_model import TrainedModelBase
 from .scoring import ScoringBase
 from .transfer import TransferredTrainedModelBase
-from .utility import DataInfoBase
\ No newline at end of file
+from .utility import DataInfoBase
+from .predictions import PredictionsBase
+from .checkpoint import CheckpointBase
+from .tensor_store import TensorStoreBase
@@ -0,0 +1,190 @@
+import datajoint as dj
+import tempfile
+import threading
+import shutil
+import torch
+import os
+from nnfabrik.utility.dj_helpers import make_hash, connect_table
+from nnfabrik.utility.nnf_helper import _load_object
+
+
+def _to_cpu(obj):
+    """Returns a copy of `obj` with all tensors (also in nested dicts, lists and tuples) copied to the CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointBase(dj.Manual):
+    """
+    Inherit from this class and decorate with your own schema to create a functional Checkpoint table,
+    and set it as the `checkpoint_table` of a TrainedModel table. The table holds the latest checkpoint
+    of every model under training, so that a training that gets interrupted can resume from there.
+    The checkpoint of a model is removed once the trained model is inserted.
+
+    Checkpoints are identified by the hash of the key of the trained model, which keeps this table
+    independent of the primary key of the TrainedModel table it serves.
+    """
+
+    # storage for the checkpoint states
+    storage = "minio"
+
+    # table level comment
+    table_comment = "Latest checkpoints of models under training"
+
+    @property
+    def definition(self):
+        definition = """
+        # {table_comment}
+        checkpoint_hash:                   char(32)     # hash of the key of the trained model
+        ---
+        checkpoint_key:                    longblob     # key of the trained model
+        epoch:                             int          # epoch at which the checkpoint was taken
+        checkpoint_state:                  attach@{storage}    # state of the model, optimizer and trainer
+        checkpoint_ts=CURRENT_TIMESTAMP:   timestamp    # UTZ timestamp at time of insertion
+        """.format(
+            table_comment=self.table_comment, storage=self.storage
+        )
+        return definition
+
+    @staticmethod
+    def checkpoint_hash(key):
+        return make_hash(key)
+
+    def save(self, key, epoch, state, table=None):
+        """
+        Replaces the checkpoint of `key` by `state` (a dictionary, e.g. of state_dicts) taken at `epoch`.
+        If given, the checkpoint is inserted into `table` instead, e.g. a FreeTable of this table on another connection.
+        """
+        table = self if table is None else table
+        checkpoint_hash = self.checkpoint_hash(key)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, "{}.pth.tar".format(checkpoint_hash))
+            torch.save(state, filepath)
+            table.insert1(
+                dict(checkpoint_hash=checkpoint_hash, checkpoint_key=key, epoch=epoch, checkpoint_state=filepath),
+                replace=True,
+            )
+
+    def restore(self, key):
+        """Returns the epoch and state of the checkpoint of `key`, or None if there is no checkpoint."""
+        checkpoint = self & dict(checkpoint_hash=self.checkpoint_hash(key))
+        if not checkpoint:
+            return None
+        temp_dir = tempfile.mkdtemp()
+        try:
+            epoch, filepath = checkpoint.fetch1("epoch", "checkpoint_state", download_path=temp_dir)
+            return epoch, _load_object(filepath)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def discard(self, key):
+        """Deletes the checkpoint of `key`."""
+        (self & dict(checkpoint_hash=self.checkpoint_hash(key))).delete_quick()
+
+
+class Checkpointer:
+    """
+    Checkpointing API handed to trainers that accept a `checkpoint` argument. A trainer resumes with `restore`
+    before its training loop, and calls `save` at the end of every epoch:
+
+        start_epoch = checkpoint.restore(model=model, optimizer=optimizer)
+        for epoch in range(start_epoch, max_epochs):
+            ...
+            checkpoint.save(epoch + 1, model=model, optimizer=optimizer, scheduler=scheduler)
+
+    `save` only takes a checkpoint every `interval` epochs. It copies the states to the CPU and returns, while the
+    checkpoint is serialized and uploaded on a background thread over a separate database connection. Hence the
+    checkpoints are not part of the transaction of `populate`, and they survive if the training fails.
+
+    Args:
+        checkpoint_table: instance of a CheckpointBase table
+        key (dict): key of the trained model
+        interval (int): minimal number of epochs between two checkpoints
+    """
+
+    def __init__(self, checkpoint_table, key, interval=1):
+        self.checkpoint_table = checkpoint_table
+        self.key = dict(key)
+        self.interval = interval
+        self.epoch = None
+        self._state = None
+        self._table = None
+        self._thread = None
+        self._error = None
+
+        checkpoint = checkpoint_table.restore(self.key)
+        if checkpoint is not None:
+            self.epoch, self._state = checkpoint
+
+    @property
+    def resumed(self):
+        """True if a checkpoint of an earlier run of this training was found."""
+        return self._state is not None
+
+    def restore(self, **objects):
+        """
+        Loads the state of the checkpoint into the given objects (anything with a `load_state_dict` method), e.g.
+        `model=model, optimizer=optimizer`, where the names have to match the ones passed to `save`.
+
+        Returns:
+            int: the epoch of the checkpoint, or 0 if there is no checkpoint
+        """
+        if self._state is None:
+            return 0
+        for name, obj in objects.items():
+            if name in self._state:
+                obj.load_state_dict(self._state[name])
+        return self.epoch
+
+    @property
+    def state(self):
+        """The complete state of the checkpoint (also entries without `load_state_dict`), or None."""
+        return self._state
+
+    def save(self, epoch, **objects):
+        """
+        Takes a checkpoint at `epoch`, if at least `interval` epochs passed since the last one. Objects with a
+        `state_dict` method (models, optimizers, schedulers) are stored with their state_dict, all others as they are.
+        Waits for the upload of the previous checkpoint, if that one is still running.
+        """
+        if self.epoch is not None and epoch - self.epoch < self.interval:
+            return
+        self.flush()
+
+        state = _to_cpu({k: v.state_dict() if hasattr(v, "state_dict") else v for k, v in objects.items()})
+        self.epoch = epoch
+        self._thread = threading.Thread(target=self._upload, args=(epoch, state), daemon=True)
+        self._thread.start()
+
+    def _upload(self, epoch, state):
+        try:
+            if self._table is None:
+                self._table = connect_table(self.checkpoint_table)
+            self.checkpoint_table.save(self.key, epoch, state, table=self._table)
+        except Exception as e:
+            self._error = e
+
+    def flush(self):
+        """Waits until the last checkpoint is uploaded, and raises the error of the upload if it failed."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Waits for the last upload, and closes the separate connection."""
+        try:
+            self.flush()
+        finally:
+            if self._table is not None:
+                self._table.connection.close()
+                self._table = None
@@ -0,0 +1,130 @@
+import datajoint as dj
+import numpy as np
+from nnfabrik.utility.metrics import model_outputs
+from .trained_model import TrainedModelBase
+
+
+class PredictionsBase(dj.Computed):
+    """
+    Inherit from this class and decorate with your own schema to create a functional Predictions table.
+    The table runs each trained model once over the data tiers in `tiers`, and stores the outputs of the model
+    together with the targets in the `Chunk` part table. Scoring tables that have their `predictions_table` set
+    read the stored predictions instead of loading the model, so that adding a new metric only costs a
+    streaming read of the predictions instead of another pass of every model over the data.
+
+    Predictions and targets are stored as float32 arrays in external storage, in chunks of whole batches of
+    at least `chunk_size` samples. DataJoint compresses the serialized blobs before they are uploaded.
+    The sizes of the batches are stored alongside, so that the original batches can be recovered.
+
+    Attributes:
+        trainedmodel_table (Datajoint Table) - an instantiation of the TrainedModelBase
+        dataset_table (Datajoint Table) - A Dataset table of nnfabrik. By default the Dataset table of the trainedmodel_table.
+        tiers (tuple) - keys of the 'dataloaders' object for which the predictions are stored
+        storage (str) - external storage for the chunks of predictions
+        chunk_size (int) - minimal number of samples per chunk
+    """
+
+    trainedmodel_table = TrainedModelBase
+    dataset_table = trainedmodel_table.dataset_table
+    tiers = ("train", "validation", "test")
+    storage = "minio"
+    chunk_size = 4096
+    model_cache = None
+    data_cache = None
+
+    # table level comment
+    table_comment = "Predictions of trained models on all data tiers"
+
+    @property
+    def definition(self):
+        definition = """
+                # {table_comment}
+                -> self.trainedmodel_table
+                ---
+                predictions_ts=CURRENT_TIMESTAMP: timestamp    # UTZ timestamp at time of insertion
+                """.format(table_comment=self.table_comment)
+        return definition
+
+    class Chunk(dj.Part):
+        @property
+        def definition(self):
+            definition = """
+                # Chunk of consecutive batches of predictions and targets
+                -> master
+                tier:                  varchar(32)      # data tier, e.g. 'test'
+                chunk_index:           int              # position of the chunk within the tier
+                ---
+                data_key:              varchar(255)     # data_key of the dataloader ('' for a single dataloader)
+                outputs:               blob@{storage}   # model outputs of all batches (float32)
+                targets:               blob@{storage}   # targets of all batches (float32)
+                batch_sizes:           longblob         # number of samples in each batch of the chunk
+                """.format(storage=self._master.storage)
+            return definition
+
+    def get_model(self, key=None):
+        if key is None:
+            key = self.fetch1('KEY')
+        if self.model_cache is None:
+            return self.trainedmodel_table().load_model(key=key, include_state_dict=True, include_dataloader=False)
+        return self.model_cache.load(key=key, include_state_dict=True, include_dataloader=False)
+
+    def get_dataloaders(self, key=None):
+        if key is None:
+            key = self.fetch1('KEY')
+        return self.dataset_table().get_dataloader(key=key) if self.data_cache is None else self.data_cache.load(key=key)
+
+    def iter_predictions(self, key, tier):
+        """
+        Reads the stored predictions of `key` on `tier`, one chunk at a time.
+
+        Yields:
+            tuple: data_key (None for a single dataloader), outputs and targets of each of the original batches
+        """
+        chunks = self.Chunk & key & dict(tier=tier)
+        chunk_keys = chunks.fetch("KEY", order_by="chunk_index")
+        if not chunk_keys:
+            raise ValueError("No predictions stored on tier '{}' for {}".format(tier, key))
+
+        for chunk_key in chunk_keys:
+            data_key, outputs, targets, batch_sizes = (self.Chunk & chunk_key).fetch1(
+                "data_key", "outputs", "targets", "batch_sizes"
+            )
+            splits = np.cumsum(batch_sizes)[:-1]
+            for batch_outputs, batch_targets in zip(np.split(outputs, splits), np.split(targets, splits)):
+                yield data_key or None, batch_outputs, batch_targets
+
+    def insert_chunk(self, key, tier, chunk_index, data_key, batches):
+        """Inserts a list of (outputs, targets) batches as a single chunk."""
+        self.Chunk.insert1(
+            dict(
+                key,
+                tier=tier,
+                chunk_index=chunk_index,
+                data_key=data_key or "",
+                outputs=np.concatenate([outputs for outputs, _ in batches]),
+                targets=np.concatenate([targets for _, targets in batches]),
+                batch_sizes=np.array([len(outputs) for outputs, _ in batches]),
+            ),
+            ignore_extra_fields=True,
+        )
+
+    def make(self, key):
+        dataloaders = self.get_dataloaders(key=key)
+        model = self.get_model(key=key)
+
+        self.insert1(key, ignore_extra_fields=True)
+        for tier in self.tiers:
+            chunk_index, chunk_data_key, batches, n_samples = 0, None, [], 0
+            for data_key, outputs, targets in model_outputs(model, dataloaders[tier]):
+                # chunks never span several data_keys
+                if batches and data_key != chunk_data_key:
+                    self.insert_chunk(key, tier, chunk_index, chunk_data_key, batches)
+                    chunk_index, batches, n_samples = chunk_index + 1, [], 0
+                chunk_data_key = data_key
+                batches.append((outputs.astype(np.float32), targets.astype(np.float32)))
+                n_samples += len(outputs)
+                if n_samples >= self.chunk_size:
+                    self.insert_chunk(key, tier, chunk_index, chunk_data_key, batches)
+                    chunk_index, batches, n_samples = chunk_index + 1, [], 0
+            if batches:
+                self.insert_chunk(key, tier, chunk_index, chunk_data_key, batches)
@@ -1,6 +1,8 @@
 import datajoint as dj
 import numpy as np
+from collections import OrderedDict
 from nnfabrik.main import Model, Dataset, Trainer, Seed, Fabrikant
+from nnfabrik.utility.metrics import model_outputs, data_batches, accumulate
 from .trained_model import TrainedModelBase
 
 
@@ -36,6 +38,12 @@ class ScoringBase(dj.Computed):
             measure function when computing a score.
         cache (object) - A Store that caches models or datasets, so that they don't need to be recomputed for each
             analysis. Ready to use: an instantiation of the FabrikCache (from ..utility.nnf_helper)
+        accumulator (callable) - optional factory (e.g. a subclass of nnfabrik.utility.metrics.Accumulator such as
+            Correlation, or a functools.partial of one) of streaming accumulators. If set, it is used instead of the
+            measure_function, so that the scores are computed batch by batch with memory independent of the size of
+            the data. The table can then also be part of a MultiScoringBase table.
+        predictions_table (Datajoint Table) - optional PredictionsBase table. If the predictions of a trained model are
+            stored there, the accumulator reads them instead of running the model over the data again.
     """
 
     trainedmodel_table = TrainedModelBase
@@ -45,6 +53,11 @@ class ScoringBase(dj.Computed):
     function_kwargs = {}
     model_cache = None
     data_cache = None
+    accumulator = None
+    predictions_table = None
+
+    # maximum number of unit scores inserted with a single query
+    unit_insert_chunk_size = 10000
 
 
     @staticmethod
@@ -100,33 +113,147 @@ class ScoringBase(dj.Computed):
                                           include_dataloader=False)
         return model
 
-    def get_dataloaders(self, key=None):
+    def get_dataloaders(self, key=None, measure_dataset=None):
         if key is None:
             key = self.fetch1('KEY')
+        if measure_dataset is None:
+            measure_dataset = self.measure_dataset
         dataloaders = self.dataset_table().get_dataloader(key=key) if self.data_cache is None else self.data_cache.load(key=key)
-        return dataloaders[self.measure_dataset]
+        return dataloaders[measure_dataset]
+
+    def has_predictions(self, key, measure_dataset=None):
+        """Returns True if the predictions for `key` on the `measure_dataset` tier are stored in the predictions_table."""
+        if self.predictions_table is None:
+            return False
+        if measure_dataset is None:
+            measure_dataset = self.measure_dataset
+        return bool(self.predictions_table.Chunk & key & dict(tier=measure_dataset))
+
+    def get_outputs(self, key, measure_dataset=None, model=None):
+        """
+        Returns an iterator over (data_key, outputs, targets) of all batches of the `measure_dataset` tier,
+        as consumed by the accumulators. The batches are read from the predictions_table if possible. Otherwise
+        the model is run over the data, and loaded beforehand unless it is passed in as `model`.
+        """
+        if measure_dataset is None:
+            measure_dataset = self.measure_dataset
+        if self.has_predictions(key, measure_dataset):
+            return self.predictions_table().iter_predictions(key, measure_dataset)
+
+        dataloaders = self.get_dataloaders(key=key, measure_dataset=measure_dataset)
+        if model is None:
+            model = self.get_model(key=key)
+        return model_outputs(model, dataloaders)
+
+    def compute_unit_scores(self, key):
+        """Computes the unit scores for `key`, either with the accumulator or with the measure_function."""
+        if self.accumulator is not None:
+            return accumulate(self.get_outputs(key), dict(score=self.accumulator))["score"]
+
+        dataloaders = self.get_dataloaders(key=key)
+        model = self.get_model(key=key)
+        return self.as_array(self.measure_function(model=model,
+                                                   dataloaders=dataloaders,
+                                                   per_unit=True,
+                                                   **self.function_kwargs))
 
     def get_overall_score(self, unit_scores):
         return np.mean(unit_scores)
 
+    @staticmethod
+    def as_array(unit_scores):
+        """Converts unit scores (list, numpy array or torch tensor) into a flat numpy array."""
+        if hasattr(unit_scores, "detach"):
+            unit_scores = unit_scores.detach().cpu().numpy()
+        return np.asarray(unit_scores).reshape(-1)
+
+    def insert_scores(self, key, unit_scores, **insert_kwargs):
+        """
+        Inserts the overall score into the master table and the unit scores into the Units part table.
+        Additional keyword arguments (e.g. `allow_direct_insert`) are passed on to the insert of the master row.
+        """
+        key = dict(key)
+        key[self.measure_attribute] = self.get_overall_score(unit_scores)
+        self.insert1(key, ignore_extra_fields=True, **insert_kwargs)
+        self.insert_unit_scores(key=key, unit_scores=unit_scores)
+
     def insert_unit_scores(self, key, unit_scores):
-        key = key.copy()
-        for unit_index, unit_score in enumerate(unit_scores):
-            key["unit_index"] = unit_index
-            key["unit_{}".format(self.measure_attribute)] = unit_score
-            self.Units.insert1(key, ignore_extra_fields=True)
+        """
+        Inserts the scores of all units into the Units part table. The rows are built as a single record array
+        and inserted in chunks of `unit_insert_chunk_size` rows, one query per chunk. When called from `make`,
+        this happens in the same transaction as the insert of the master row.
+        """
+        unit_scores = self.as_array(unit_scores)
+        units = self.Units()
+        score_attribute = "unit_{}".format(self.measure_attribute)
+        key_attributes = [k for k in units.primary_key if k != "unit_index"]
+
+        records = np.empty(
+            len(unit_scores),
+            dtype=[(k, object) for k in key_attributes] + [("unit_index", np.int64), (score_attribute, np.float64)],
+        )
+        for k in key_attributes:
+            records[k] = key[k]
+        records["unit_index"] = np.arange(len(unit_scores))
+        records[score_attribute] = unit_scores
+
+        for start in range(0, len(records), self.unit_insert_chunk_size):
+            units.insert(records[start : start + self.unit_insert_chunk_size])
 
     def make(self, key):
-        dataloaders = self.get_dataloaders(key=key)
-        model = self.get_model(key=key)
-        unit_scores = self.measure_function(model=model,
-                                                 dataloaders=dataloaders,
-                                                 per_unit=True,
-                                                 **self.function_kwargs)
+        unit_scores = self.as_array(self.compute_unit_scores(key))
+        self.insert_scores(key, unit_scores)
+
+
+class MultiScoringBase(ScoringBase):
+    """
+    A template table that populates several ScoringBase tables from a single pass of the model over the data.
+    Instead of every scoring table loading the model and running it over its `measure_dataset` on its own,
+    the model is loaded once and its outputs on each data tier are streamed into the accumulators of all
+    scoring tables at once. This table itself only keeps track of the trained models that have been scored.
+
+    Attributes:
+        scoring_tables (list) - ScoringBase table classes to populate. Each of them needs to have its `accumulator`
+            set, and all of them need to share the trainedmodel_table of this table.
+    """
+
+    scoring_tables = []
+    Units = None
+
+    # table level comment
+    table_comment = "Trained models that were scored by a group of scoring tables"
+
+    @property
+    def definition(self):
+        definition = """
+                # {table_comment}
+                -> self.trainedmodel_table
+                ---
+                multiscore_ts=CURRENT_TIMESTAMP: timestamp    # UTZ timestamp at time of insertion
+                """.format(table_comment=self.table_comment)
+        return definition
+
+    def make(self, key):
+        # group the tables that still lack this key by data tier, so that each tier is only passed over once
+        tiers = OrderedDict()
+        for table in self.scoring_tables:
+            table = table()
+            if table.accumulator is None:
+                raise ValueError("{} has no accumulator and can't be part of a scoring group".format(table.__class__.__name__))
+            if not (table & key):
+                tiers.setdefault(table.measure_dataset, []).append(table)
+
+        # the model is only loaded (once for all tiers) if the predictions of any of the tiers are not stored
+        needs_model = any(not self.has_predictions(key, measure_dataset) for measure_dataset in tiers)
+        model = self.get_model(key=key) if needs_model else None
+        for measure_dataset, tables in tiers.items():
+            batches = self.get_outputs(key, measure_dataset=measure_dataset, model=model)
+            scores = accumulate(batches, {i: table.accumulator for i, table in enumerate(tables)})
+            for i, table in enumerate(tables):
+                # the scoring tables are not populated themselves, hence inserts into them have to be allowed
+                table.insert_scores(key, scores[i], allow_direct_insert=True)
 
-        key[self.measure_attribute] = self.get_overall_score(unit_scores)
         self.insert1(key, ignore_extra_fields=True)
-        self.insert_unit_scores(key=key, unit_scores=unit_scores)
 
 
 class SummaryScoringBase(ScoringBase):
@@ -175,16 +302,19 @@ class MeasuresBase(ScoringBase):
                 """.format(measure_attribute=self._master.measure_attribute)
             return definition
 
-    def make(self, key):
-
+    def compute_unit_scores(self, key):
+        """Computes the unit scores for `key` from the data alone, with the accumulator or the measure_function."""
         dataloaders = self.get_dataloaders(key=key)
-        unit_scores = self.measure_function(dataloaders=dataloaders,
+        if self.accumulator is not None:
+            return accumulate(data_batches(dataloaders), dict(score=self.accumulator))["score"]
+
+        return self.as_array(self.measure_function(dataloaders=dataloaders,
                                                    per_unit=True,
-                                                   **self.function_kwargs)
+                                                   **self.function_kwargs))
 
-        key[self.measure_attribute] = self.get_overall_score(unit_scores)
-        self.insert1(key, ignore_extra_fields=True)
-        self.insert_unit_scores(key=key, unit_scores=unit_scores)
+    def make(self, key):
+        unit_scores = self.as_array(self.compute_unit_scores(key))
+        self.insert_scores(key, unit_scores)
 
 
 class SummaryMeasuresBase(MeasuresBase):
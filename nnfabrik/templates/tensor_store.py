@@ -0,0 +1,45 @@
+import datajoint as dj
+from nnfabrik.utility.storage import store_tensors, assemble_state_dict
+
+
+class TensorStoreBase(dj.Manual):
+    """
+    Inherit from this class and decorate with your own schema to create a functional TensorStore table, and set it
+    as the `tensor_store` of a TrainedModel table. The trained models then store a manifest in their ModelStorage,
+    which refers to the tensors of the state_dict by the hashes of their content, while the tensors themselves are
+    stored in this table. Every distinct tensor is stored only once, so that tensors shared across trained models
+    (e.g. a frozen core in subsequent transfer steps) are neither uploaded nor stored again.
+
+    Tensors are fetched as external blobs, which DataJoint keeps in its local cache if `dj.config["cache"]` is set.
+    Tensors are never deleted along with the trained models that refer to them.
+    """
+
+    # storage for the tensors
+    storage = "minio"
+
+    # table level comment
+    table_comment = "Content-addressed storage of the tensors of trained models"
+
+    @property
+    def definition(self):
+        definition = """
+        # {table_comment}
+        tensor_digest:                     char(32)     # MD5 hash of dtype, shape and data of the tensor
+        ---
+        tensor_dtype:                      varchar(32)  # torch dtype of the tensor
+        tensor_shape:                      longblob     # shape of the tensor
+        tensor_nbytes:                     bigint       # size of the data in bytes
+        tensor_data:                       blob@{storage}    # data of the tensor as raw bytes (uint8)
+        tensor_ts=CURRENT_TIMESTAMP:       timestamp    # UTZ timestamp at time of insertion
+        """.format(
+            table_comment=self.table_comment, storage=self.storage
+        )
+        return definition
+
+    def store(self, state_dict):
+        """Stores the tensors of `state_dict` that are not stored yet, and returns the manifest of the state_dict."""
+        return store_tensors(self, state_dict)
+
+    def assemble(self, manifest):
+        """Returns the state_dict described by `manifest`."""
+        return assemble_state_dict(self, manifest)
@@ -1,13 +1,38 @@
 import datajoint as dj
 import tempfile
-import torch
+import shutil
 import os
+import inspect
 from nnfabrik.main import Model, Dataset, Trainer, Seed, Fabrikant
 from nnfabrik.builder import get_all_parts, get_model, get_trainer
-from nnfabrik.utility.dj_helpers import gitlog, make_hash
+from nnfabrik.utility.dj_helpers import gitlog, make_hash, connect_table
+from nnfabrik.utility.parallel import parallel_populate
+from nnfabrik.utility.storage import (
+    state_dict_filename,
+    save_state_dict_file,
+    load_state_dict_file,
+    cast_state_dict,
+    store_tensors,
+    assemble_state_dict,
+    save_manifest,
+    load_manifest,
+    MANIFEST_SUFFIX,
+    UploadQueue,
+)
 from .utility import DataInfoBase
+from .checkpoint import Checkpointer, _to_cpu
 from datajoint.fetch import DataJointError
 import warnings
+from collections import Counter
+
+
+# data_info of all datasets used in this process, by table and dataset key
+_data_info_cache = {}
+
+
+def clear_data_info_cache():
+    """Empties the in-process cache of data_info."""
+    _data_info_cache.clear()
 
 
 class TrainedModelBase(dj.Computed):
@@ -29,6 +54,58 @@ class TrainedModelBase(dj.Computed):
     # storage for the ModelStorage table
     storage = "minio"
 
+    # format of the stored state_dict: "torch" (torch.save) or "flat" (memory-mappable, see nnfabrik.utility.storage)
+    state_dict_format = "torch"
+
+    # number of background threads that save and upload trained models. If 0, trained models are saved within `make`.
+    # Otherwise `make` returns right after the training, and the trained model is inserted by a background thread
+    # on a separate connection once its state is uploaded. Not compatible with the `gitlog` decorator, and not used
+    # when populating with `reserve_jobs=True`, as the job of a key would be completed before its entry exists.
+    upload_workers = 0
+
+    # set by the `gitlog` decorator
+    has_gitlog = False
+
+    # True while `populate` runs with reserved jobs, which requires the trained models to be inserted within `make`
+    _sync_uploads = False
+
+    # additional callback of the trainings of the current `populate` call
+    _populate_call_back = None
+
+    # maximal number of trained models waiting for their upload, before `make` blocks
+    max_pending_uploads = 2
+
+    # optional reduced precision ("float16" or "bfloat16") to store floating point tensors of the state_dict in.
+    # They are cast back to their original dtypes when loaded.
+    state_dict_dtype = None
+
+    # optional compression of the stored state_dict: "gzip", "zstd" (requires zstandard) or "lz4" (requires lz4).
+    # The compression is inferred from the file name when loading, so it can be changed for a populated table.
+    state_dict_compression = None
+
+    # optional TensorStoreBase table. If set, every distinct tensor of the trained models is stored only once in
+    # that table, and ModelStorage holds a manifest that refers to the tensors (state_dict_format and
+    # state_dict_compression are then ignored)
+    tensor_store = None
+
+    # optional nnfabrik.utility.storage.AttachmentCache, that keeps downloaded model states on the local disk
+    attachment_cache = None
+
+    # optional CheckpointBase table. Trainers that accept a `checkpoint` argument can then save checkpoints during
+    # training, and resume from the last one if the training of a key was interrupted (see templates.checkpoint)
+    checkpoint_table = None
+
+    # minimal number of epochs between two checkpoints
+    checkpoint_interval = 1
+
+    # if True, models are never built from the dataloaders when `load_model` is called with include_dataloader=False:
+    # missing entries of the data_info_table are populated on demand, and errors are raised instead of falling back
+    strict_data_info = False
+
+    # counts of how data_info was obtained by `get_data_info`, and how often `load_model` fell back to the dataloaders
+    # (keys: "cache_hits", "fetched", "populated", "dataloader_fallbacks"), shared by all TrainedModel tables
+    data_info_stats = Counter()
+
     # delimitter to use when concatenating comments from model, dataset, and trainer tables
     comment_delimitter = "."
 
@@ -101,14 +178,105 @@ class TrainedModelBase(dj.Computed):
 
         # if trained model exist and include_state_dict is True
         if include_state_dict and (self.ModelStorage & key):
-            with tempfile.TemporaryDirectory() as temp_dir:
-                state_dict_path = (self.ModelStorage & key).fetch1(
-                    "model_state", download_path=temp_dir
-                )
-                ret["state_dict"] = torch.load(state_dict_path)
+            ret["state_dict"] = self.fetch_state_dict(key)
 
         return ret
 
+    def fetch_state_dict(self, key):
+        """
+        Downloads and loads the state_dict stored for `key` in self.ModelStorage. State dicts stored in the
+        flat format are memory-mapped, so that tensors are only read from disk when they are accessed.
+        If `attachment_cache` is set, the state_dict is served from the local cache whenever possible.
+        If the stored file is a manifest, the state_dict is assembled from the `tensor_store`.
+        """
+        if self.attachment_cache is not None:
+            # the cached file must not be evicted by other processes before it is loaded (or memory-mapped)
+            with self.attachment_cache.open(self.ModelStorage & key, "model_state") as state_dict_path:
+                return self._load_state_dict(key, state_dict_path)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            state_dict_path = (self.ModelStorage & key).fetch1("model_state", download_path=temp_dir)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        return self._load_state_dict(key, state_dict_path, cleanup_dir=temp_dir)
+
+    def _load_state_dict(self, key, state_dict_path, cleanup_dir=None):
+        """Loads the state_dict (or the manifest) at `state_dict_path` and removes `cleanup_dir` afterwards."""
+        if str(state_dict_path).endswith(MANIFEST_SUFFIX):
+            manifest = load_manifest(state_dict_path, cleanup_dir=cleanup_dir)
+            if self.tensor_store is None:
+                raise ValueError("The state_dict of {} is stored in a tensor store, but `tensor_store` is not set".format(key))
+            return assemble_state_dict(self.tensor_store(), manifest)
+        return load_state_dict_file(state_dict_path, cleanup_dir=cleanup_dir)
+
+    def save_state_dict(self, model_state, directory, key, tensor_store=None):
+        """
+        Saves `model_state` for `key` into `directory` in the format, dtype and compression set by `state_dict_format`,
+        `state_dict_dtype` and `state_dict_compression`, and returns the path of the resulting file to be attached
+        to self.ModelStorage. If `tensor_store` is set, the tensors are stored there instead, and the
+        returned file is the manifest of the state_dict. Another instance of the tensor store (e.g. on a
+        separate connection) can be passed as `tensor_store`.
+        """
+        if self.tensor_store is not None:
+            if tensor_store is None:
+                tensor_store = self.tensor_store()
+            if self.state_dict_dtype is not None:
+                model_state = cast_state_dict(model_state, self.state_dict_dtype)
+            filepath = os.path.join(directory, make_hash(key) + MANIFEST_SUFFIX)
+            save_manifest(store_tensors(tensor_store, model_state), filepath)
+            return filepath
+
+        filename = state_dict_filename(make_hash(key), self.state_dict_format, self.state_dict_compression)
+        filepath = os.path.join(directory, filename)
+        save_state_dict_file(
+            model_state,
+            filepath,
+            format=self.state_dict_format,
+            dtype=self.state_dict_dtype,
+            compression=self.state_dict_compression,
+        )
+        return filepath
+
+    def get_data_info(self, key, populate=False):
+        """
+        Returns the data_info of the dataset in `key` from the data_info_table. The data_info is cached in the
+        process, so that it is only fetched once per dataset.
+
+        Args:
+            key - key restricting the dataset_table to a single dataset
+            populate (bool) - if True, a missing entry of the data_info_table is computed on demand. Outside of a
+                              transaction it is populated, otherwise (e.g. in the `make` of a scoring table) it is
+                              computed without being inserted.
+        """
+        data_info_table = self.data_info_table()
+        dataset_attributes = self.dataset_table().primary_key
+        if all(k in key for k in dataset_attributes):
+            dataset_key = {k: key[k] for k in dataset_attributes}
+        else:
+            dataset_key = (self.dataset_table & key).fetch1("KEY")
+
+        cache_key = (data_info_table.full_table_name,) + tuple(dataset_key[k] for k in dataset_attributes)
+        if cache_key in _data_info_cache:
+            self.data_info_stats["cache_hits"] += 1
+            return _data_info_cache[cache_key]
+
+        if populate and not (data_info_table & dataset_key):
+            if self.connection.in_transaction:
+                # populate can not be called within a transaction
+                data_info = data_info_table.compute_data_info(dataset_key)
+            else:
+                data_info_table.populate(dataset_key)
+                data_info = (data_info_table & dataset_key).fetch1("data_info")
+            self.data_info_stats["populated"] += 1
+        else:
+            data_info = (data_info_table & dataset_key).fetch1("data_info")
+            self.data_info_stats["fetched"] += 1
+
+        _data_info_cache[cache_key] = data_info
+        return data_info
+
     def load_model(
         self,
         key=None,
@@ -116,6 +284,7 @@ class TrainedModelBase(dj.Computed):
         include_trainer=False,
         include_state_dict=True,
         seed: int = None,
+        strict_data_info: bool = None,
     ):
         """
         Load a single entry of the model. If state_dict is available, the model will be loaded with state_dict as well.
@@ -132,6 +301,9 @@ class TrainedModelBase(dj.Computed):
             include_trainer - If False (default), will not load or return the trainer.
             include_state_dict - If True, the model is loaded with state_dict if key corresponds to a trained entry.
             seed - Optional seed. If not given and a corresponding entry exists in self.seed_table, seed is taken from there
+            strict_data_info - If True and include_dataloader is False, the model is only ever built from the data_info,
+                               which is populated on demand, and errors are raised instead of building the dataloaders.
+                               Defaults to the `strict_data_info` attribute of the table.
 
         Returns
             dataloaders - Loaded dictionary (train, test, validation) of dictionary (data_key) of dataloaders
@@ -151,9 +323,12 @@ class TrainedModelBase(dj.Computed):
             key, include_trainer=include_trainer, include_state_dict=include_state_dict
         )
 
+        if strict_data_info is None:
+            strict_data_info = self.strict_data_info
+
         if not include_dataloader:
             try:
-                data_info = (self.data_info_table & key).fetch1("data_info")
+                data_info = self.get_data_info(key, populate=strict_data_info)
                 model_config_dict = dict(
                     model_fn=config_dict["model_fn"],
                     model_config=config_dict["model_config"],
@@ -176,6 +351,9 @@ class TrainedModelBase(dj.Computed):
                 )
 
             except (TypeError, AttributeError, DataJointError):
+                if strict_data_info:
+                    raise
+                self.data_info_stats["dataloader_fallbacks"] += 1
                 warnings.warn(
                     "Model could not be built without the dataloader. Dataloader will be built in order to create the model. "
                     "Make sure to have an The 'model_fn' also has to be able to"
@@ -200,6 +378,164 @@ class TrainedModelBase(dj.Computed):
         """
         pass
 
+    def train(self, key, model, dataloaders, trainer, seed):
+        """
+        Runs `trainer` on `model` for `key`, with the connection kept alive through the callbacks. If a
+        checkpoint_table is set and the trainer accepts a `checkpoint` argument, it is handed a Checkpointer
+        for `key`, which holds the last checkpoint of an interrupted training of this key, if there is one.
+
+        Returns
+            score, output, model_state - as returned by the trainer
+        """
+
+        # define callback with pinging
+        def call_back(**kwargs):
+            self.connection.ping()
+            self.call_back(**kwargs)
+            if self._populate_call_back is not None:
+                # trainers usually do not pass `uid`, but the hook needs to know which key is under training
+                self._populate_call_back(**dict(kwargs, uid=kwargs.get("uid", key)))
+
+        trainer_kwargs = dict(model=model, dataloaders=dataloaders, seed=seed, uid=key, cb=call_back)
+        if self.checkpoint_table is None or "checkpoint" not in inspect.signature(trainer).parameters:
+            return trainer(**trainer_kwargs)
+
+        checkpoint = Checkpointer(self.checkpoint_table(), key, interval=self.checkpoint_interval)
+        try:
+            return trainer(checkpoint=checkpoint, **trainer_kwargs)
+        finally:
+            checkpoint.close()
+
+    def insert_trained_model(self, key, model_state):
+        """
+        Saves `model_state`, and inserts `key` (the complete entry of the trained model) together with the state into
+        self.ModelStorage. The checkpoint of the key, if any, is removed in the same transaction.
+        If `upload_workers` is set, this happens on a background thread, and the entry only appears in the table once
+        the state is uploaded. Call `flush_uploads` (as `populate` does) to wait for all pending uploads.
+        """
+        if not self.upload_workers or self._sync_uploads:
+            return self._insert_trained_model(key, model_state)
+
+        if self.has_gitlog:
+            # the GitLog entry is inserted right after `make`, and requires the entry of the trained model
+            warnings.warn("Uploads of trained models are not run in the background for tables decorated with gitlog.")
+            return self._insert_trained_model(key, model_state)
+
+        # the state of the next model must not be held on the GPU while waiting for the upload
+        self.upload_queue().submit(key, self._upload_trained_model, dict(key), _to_cpu(model_state))
+
+    def _insert_trained_model(self, key, model_state, tables=None):
+        if tables is None:
+            tables = (
+                self,
+                self.ModelStorage(),
+                None if self.checkpoint_table is None else self.checkpoint_table(),
+                None if self.tensor_store is None else self.tensor_store(),
+            )
+        table, model_storage, checkpoints, tensor_store = tables
+        primary_key = {k: key[k] for k in self.primary_key}
+
+        # save resulting model_state into a temporary file to be attached
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = self.save_state_dict(model_state, temp_dir, primary_key, tensor_store=tensor_store)
+            table.insert1(key)
+            model_storage.insert1(dict(key, model_state=filepath), ignore_extra_fields=True)
+
+        if checkpoints is not None:
+            (checkpoints & dict(checkpoint_hash=self.checkpoint_table.checkpoint_hash(primary_key))).delete_quick()
+
+    def _upload_trained_model(self, key, model_state):
+        """Inserts the trained model from an upload thread, on the thread's own connection."""
+        local = self.upload_queue().local
+        if not hasattr(local, "tables"):
+            table = connect_table(self)
+            local.tables = (
+                table,
+                connect_table(self.ModelStorage(), connection=table.connection),
+                None
+                if self.checkpoint_table is None
+                else connect_table(self.checkpoint_table(), connection=table.connection),
+                None if self.tensor_store is None else connect_table(self.tensor_store(), connection=table.connection),
+            )
+        table = local.tables[0]
+
+        with table.connection.transaction:
+            # another worker might have trained the same key while the upload was pending
+            if not (table & {k: key[k] for k in self.primary_key}):
+                self._insert_trained_model(key, model_state, tables=local.tables)
+
+    def upload_queue(self):
+        """Returns the UploadQueue of this table class, which is shared by all instances in the process."""
+        cls = self.__class__
+        if cls.__dict__.get("_upload_queue") is None:
+            cls._upload_queue = UploadQueue(workers=self.upload_workers, max_pending=self.max_pending_uploads)
+        return cls._upload_queue
+
+    def flush_uploads(self):
+        """
+        Waits for the uploads of all trained models started in this process.
+
+        Returns
+            errors - list of (key, exception) tuples of all failed uploads
+        """
+        queue = self.__class__.__dict__.get("_upload_queue")
+        return [] if queue is None else queue.flush()
+
+    def populate(self, *restrictions, call_back=None, **populate_kwargs):
+        """
+        Populates the table as `dj.Computed.populate` does. With `upload_workers`, it additionally waits for the
+        uploads of all trained models before returning. Failed uploads are reported as failed keys if errors are
+        suppressed, and raised otherwise.
+
+        If given, `call_back` is called during the training of every key of this call, in addition to `self.call_back`
+        and with the same arguments, where `uid` defaults to the key under training. An exception raised from it aborts
+        the training, like any error of `make`.
+
+        With `reserve_jobs=True`, trained models are always inserted within `make`: DataJoint completes the job of a
+        key as soon as `make` returns, and other workers would train the same key again while its upload is pending.
+        """
+        if self.upload_workers and populate_kwargs.get("reserve_jobs", False):
+            warnings.warn("Trained models are not uploaded in the background when populating with reserved jobs.")
+            self._sync_uploads = True
+        self._populate_call_back = call_back
+        try:
+            errors = super().populate(*restrictions, **populate_kwargs)
+        finally:
+            self._sync_uploads = False
+            self._populate_call_back = None
+        upload_errors = self.flush_uploads()
+        if upload_errors:
+            if not populate_kwargs.get("suppress_errors", False):
+                raise upload_errors[0][1]
+            if not populate_kwargs.get("return_exception_objects", False):
+                upload_errors = [(key, repr(error)) for key, error in upload_errors]
+            errors = list(errors or []) + upload_errors
+        return errors
+
+    def parallel_populate(self, *restrictions, n_workers=None, threads_per_worker=None, **populate_kwargs):
+        """
+        Trains all models in the `key_source` (restricted by `restrictions`) with multiple worker processes.
+        The workers use the job reservation of DataJoint, so that no key is trained twice. Keys that fail
+        are collected and returned instead of interrupting the other trainings.
+
+        Args:
+            restrictions - restrictions on the `key_source`, as for `populate`
+            n_workers - number of worker processes. Defaults to the number of CPUs divided by `threads_per_worker`.
+            threads_per_worker - number of threads PyTorch may use in each worker. Set this on CPU-only hosts
+                                 to avoid oversubscribing the machine.
+            populate_kwargs - additional keyword arguments passed on to `populate` in each worker.
+
+        Returns
+            errors - list of (key, error message) tuples of all failed keys
+        """
+        return parallel_populate(
+            self,
+            *restrictions,
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            **populate_kwargs
+        )
+
     def make(self, key):
         """
         Given key specifying configuration for dataloaders, model and trainer,
@@ -214,32 +550,16 @@ class TrainedModelBase(dj.Computed):
             key, include_trainer=True, include_state_dict=False, seed=seed
         )
 
-        # define callback with pinging
-        def call_back(**kwargs):
-            self.connection.ping()
-            self.call_back(**kwargs)
-
         # model training
-        score, output, model_state = trainer(
-            model=model, dataloaders=dataloaders, seed=seed, uid=key, cb=call_back
-        )
-
-        # save resulting model_state into a temporary file to be attached
-        with tempfile.TemporaryDirectory() as temp_dir:
-            filename = make_hash(key) + ".pth.tar"
-            filepath = os.path.join(temp_dir, filename)
-            torch.save(model_state, filepath)
-
-            key["score"] = score
-            key["output"] = output
-            key["fabrikant_name"] = fabrikant_name
-            comments = []
-            comments.append((self.trainer_table & key).fetch1("trainer_comment"))
-            comments.append((self.model_table & key).fetch1("model_comment"))
-            comments.append((self.dataset_table & key).fetch1("dataset_comment"))
-            key["comment"] = self.comment_delimitter.join(comments)
-            self.insert1(key)
-
-            key["model_state"] = filepath
-
-            self.ModelStorage.insert1(key, ignore_extra_fields=True)
+        score, output, model_state = self.train(dict(key), model, dataloaders, trainer, seed)
+
+        key["score"] = score
+        key["output"] = output
+        key["fabrikant_name"] = fabrikant_name
+        comments = []
+        comments.append((self.trainer_table & key).fetch1("trainer_comment"))
+        comments.append((self.model_table & key).fetch1("model_comment"))
+        comments.append((self.dataset_table & key).fetch1("dataset_comment"))
+        key["comment"] = self.comment_delimitter.join(comments)
+
+        self.insert_trained_model(key, model_state)
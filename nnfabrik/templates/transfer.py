@@ -1,9 +1,8 @@
 import datajoint as dj
-import tempfile
-import torch
-import os
+from functools import reduce
 from nnfabrik.main import Model, Dataset, Trainer, Seed, Fabrikant
-from nnfabrik.utility.dj_helpers import gitlog, make_hash
+from nnfabrik.utility.dj_helpers import gitlog
+from nnfabrik.utility.parallel import drain_populate
 from .trained_model import TrainedModelBase
 
 
@@ -48,6 +47,37 @@ class TransferredTrainedModelBase(TrainedModelBase):
     class ModelStorage(TrainedModelBase.ModelStorage):
         pass
 
+    # if True, the key_source contains the keys of all transfer steps whose previous models are trained,
+    # instead of the keys of the next step only (see `schedule`)
+    all_steps = False
+
+    # cache of the key_source and the recipes, only set while `populate` is running
+    _populate_cache = None
+
+    def _cached(self, name, compute):
+        """Returns compute(), cached under `name` for the duration of the current populate call."""
+        if self._populate_cache is None:
+            return compute()
+        if name not in self._populate_cache:
+            self._populate_cache[name] = compute()
+        return self._populate_cache[name]
+
+    def _recipe_steps(self):
+        """
+        Returns a list of (recipe, transfer steps) tuples for all transfer recipes, where the transfer steps are
+        the set of all steps the recipe has entries for. Takes a single query per recipe table.
+        """
+
+        def compute():
+            recipes = self.transfer_recipe if isinstance(self.transfer_recipe, list) else [self.transfer_recipe]
+            recipe_steps = []
+            for recipe in recipes:
+                recipe = recipe() if isinstance(recipe, type) else recipe
+                recipe_steps.append((recipe, set((dj.U("transfer_step") & recipe).fetch("transfer_step"))))
+            return recipe_steps
+
+        return self._cached("recipe_steps", compute)
+
     def _transfer_recipe(self, transfer_step):
         """
         Combines multiple transfer recipes and their resitrictions as specified by post_restr attribute.
@@ -62,25 +92,26 @@ class TransferredTrainedModelBase(TrainedModelBase):
         ```
 
         The rest (combining the recipes and their restrictions) is taken care of by this method.
+        The steps of all recipes are looked up once, and cached for the duration of a populate call.
 
         Args:
             transfer_step (int): table population trasnfer step.
 
         Returns:
             string or datajoint AndList: A single or combined restriction of one or multiple recipes, respectively.
+            None, if no recipe has entries for the transfer step.
         """
 
         if isinstance(self.transfer_recipe, list):
 
             # get the recipes that have a entry for a specific transfer step
-            # transfer_recipe = [tr & f"transfer_step = {transfer_step}" for tr in self.transfer_recipe if tr & f"transfer_step = {transfer_step}"]
-            transfer_recipe = []
-            # loop over the transfer recipes
-            for tr in self.transfer_recipe:
-                # check if an entry exists for a specific transfer step in the recipe
-                if tr & f"transfer_step = {transfer_step}":
-                    # if it exists add that entry to the list of recipes (relevant for a specific transfer step)
-                    transfer_recipe.append(tr & f"transfer_step = {transfer_step}")
+            transfer_recipe = [
+                recipe & "transfer_step = {}".format(transfer_step)
+                for recipe, steps in self._recipe_steps()
+                if transfer_step in steps
+            ]
+            if not transfer_recipe:
+                return None
 
             # join all the recipes (and their post_restr)
             joined = transfer_recipe[0]
@@ -96,71 +127,140 @@ class TransferredTrainedModelBase(TrainedModelBase):
         else:
             return self.transfer_recipe
 
-    @property
-    def key_source(self):
+    def _step_source(self, transfer_step):
+        """
+        Returns the keys of all models of `transfer_step`, for which the models of the previous step are trained.
+        For transfer step 0, these are all combinations of the Model, Dataset, Trainer and Seed tables.
+        """
+        if transfer_step == 0:
+            # normal entries as a combinatio of Dataset, Model, Trainer, and Seed tables
+            step_0 = self.model_table * self.dataset_table * self.trainer_table * self.seed_table
 
-        if hasattr(self, "transfer_recipe"):
+            # add transfer_step and prev_hash as prim keys
+            base = dj.U('transfer_step',
+                        'prev_model_fn', 'prev_model_hash',
+                        'prev_dataset_fn', 'prev_dataset_hash',
+                        'prev_trainer_fn', 'prev_trainer_hash') * step_0.proj(transfer_step='0',
+                                                                            prev_model_fn='""', prev_model_hash='""',
+                                                                            prev_dataset_fn='""', prev_dataset_hash='""',
+                                                                            prev_trainer_fn='""', prev_trainer_hash='""')
+            return base.proj()
 
-            # project (rename) attributes of the existing transfereedmodel table to the same name but with prefix "prev"
-            prev_transferredmodel = self.proj(prev_model_fn='current_model_fn', prev_model_hash='current_model_hash',
-                                               prev_dataset_fn='current_dataset_fn', prev_dataset_hash='current_dataset_hash',
-                                               prev_trainer_fn='current_trainer_fn', prev_trainer_hash='current_trainer_hash',
-                                               prev_step='transfer_step', transfer_step='transfer_step + 1') * dj.U('transfer_step', # make these attributes primary keys
-                                                                                                                    'prev_model_fn', 'prev_model_hash',
-                                                                                                                    'prev_dataset_fn', 'prev_dataset_hash',
-                                                                                                                    'prev_trainer_fn', 'prev_trainer_hash')
+        recipe = self._transfer_recipe(transfer_step)
+        if recipe is None:
+            return self._step_source(0) & False
 
-            # get the current transfer step
-            transfer_step = prev_transferredmodel.fetch('transfer_step').max() if prev_transferredmodel else 0
+        # project (rename) attributes of the existing transfereedmodel table to the same name but with prefix "prev"
+        prev_transferredmodel = self.proj(prev_model_fn='current_model_fn', prev_model_hash='current_model_hash',
+                                           prev_dataset_fn='current_dataset_fn', prev_dataset_hash='current_dataset_hash',
+                                           prev_trainer_fn='current_trainer_fn', prev_trainer_hash='current_trainer_hash',
+                                           prev_step='transfer_step', transfer_step='transfer_step + 1') & "prev_step = {}".format(transfer_step - 1)
 
-            if transfer_step:
+        # get the necessay attributes to filter the prev_transferredmodel with the transfer recipe
+        prev_transferredmodel = dj.U('transfer_step', 'prev_model_fn', 'prev_model_hash', 'prev_dataset_fn', 'prev_dataset_hash', 'prev_trainer_fn', 'prev_trainer_hash') & prev_transferredmodel
 
-                # get the necessay attributes to filter the prev_transferredmodel with the transfer recipe
-                prev_transferredmodel = dj.U('transfer_step', 'prev_model_fn', 'prev_model_hash', 'prev_dataset_fn', 'prev_dataset_hash', 'prev_trainer_fn', 'prev_trainer_hash') & prev_transferredmodel
+        # get the entries that match the one in TransferRecipe (for specification of previous)
+        transfer_from = prev_transferredmodel * recipe
 
-                # get the entries that match the one in TransferRecipe (for specification of previous)
-                transfer_from = prev_transferredmodel * self._transfer_recipe(transfer_step)
+        transfers = dj.U("transfer_step",
+                         "model_fn", "model_hash",
+                         "dataset_fn", "dataset_hash",
+                         "trainer_fn", "trainer_hash",
+                         "seed",
+                         "prev_model_fn", "prev_model_hash",
+                         "prev_dataset_fn", "prev_dataset_hash",
+                         "prev_trainer_fn", "prev_trainer_hash") & self.model_table * self.dataset_table * self.trainer_table * self.seed_table * transfer_from & recipe.post_restr
 
-                transfers = dj.U("transfer_step",
-                                "model_fn", "model_hash",
-                                "dataset_fn", "dataset_hash",
-                                "trainer_fn", "trainer_hash",
-                                "seed",
-                                "prev_model_fn", "prev_model_hash",
-                                "prev_dataset_fn", "prev_dataset_hash",
-                                "prev_trainer_fn", "prev_trainer_hash") & Model * Dataset * Trainer * Seed * transfer_from & self._transfer_recipe(transfer_step).post_restr
+        return transfers.proj()
 
-                return transfers.proj()
+    def current_step(self):
+        """Returns the highest transfer step in the table (a single aggregate query), or None if the table is empty."""
+        return dj.U().aggr(self, max_step="max(transfer_step)").fetch1("max_step")
 
-            else:
+    @property
+    def key_source(self):
+        """
+        The keys of the step following the highest transfer step in the table (step 0 for an empty table, or if
+        there is no transfer_recipe). If `all_steps` is set, the keys of all steps whose previous models are
+        trained, i.e. the union over the steps of all recipes. Built once per populate call.
+        """
 
-                # set of models to be trained from scratch (I arbitrary chose to only train if trainer_id + model_id < 3)
-                step_0 = Model * Dataset * Trainer * Seed
+        def compute():
+            if not hasattr(self, "transfer_recipe"):
+                return self._step_source(0)
+            if self.all_steps:
+                steps = sorted(set.union({0}, *[steps for _, steps in self._recipe_steps()]))
+                return reduce(lambda a, b: a + b, [self._step_source(step) for step in steps])
+            current_step = self.current_step()
+            return self._step_source(0 if current_step is None else current_step + 1)
 
-                # add transfer_step and prev_hash as prim keys
-                base = dj.U('transfer_step',
-                            'prev_model_fn', 'prev_model_hash',
-                            'prev_dataset_fn', 'prev_dataset_hash',
-                            'prev_trainer_fn', 'prev_trainer_hash') * step_0.proj(transfer_step='0',
-                                                                                prev_model_fn='""', prev_model_hash='""',
-                                                                                prev_dataset_fn='""', prev_dataset_hash='""',
-                                                                                prev_trainer_fn='""', prev_trainer_hash='""')
-                return base.proj()
+        return self._cached("key_source", compute)
 
-        else:
-            # normal entries as a combinatio of Dataset, Model, Trainer, and Seed tables
-            step_0 = Model * Dataset * Trainer * Seed
+    def populate(self, *restrictions, all_steps=None, **populate_kwargs):
+        """
+        Populates the table as `TrainedModelBase.populate` does, with the key_source and the transfer recipes
+        evaluated only once for the whole call. If `all_steps` is given, it overrides the `all_steps` attribute
+        for this call.
+        """
+        previous_all_steps = self.all_steps
+        if all_steps is not None:
+            self.all_steps = all_steps
+        self._populate_cache = {}
+        try:
+            return super().populate(*restrictions, **populate_kwargs)
+        finally:
+            self._populate_cache = None
+            self.all_steps = previous_all_steps
+
+    def schedule(self, *restrictions, n_workers=None, threads_per_worker=None, poll_interval=10, **populate_kwargs):
+        """
+        Trains all transfer steps with multiple worker processes, treating the transfer recipes as a dependency graph:
+        every model is trained as soon as the model of the previous step it is transferred from is trained, while
+        independent branches are trained concurrently. Workers re-evaluate the key_source of all steps after every
+        trained model, and wait for new keys as long as other workers are still training.
+        See `nnfabrik.utility.parallel.drain_populate` for details.
 
-            # add transfer_step and prev_hash as prim keys
-            base = dj.U('transfer_step',
-                        'prev_model_fn', 'prev_model_hash',
-                        'prev_dataset_fn', 'prev_dataset_hash',
-                        'prev_trainer_fn', 'prev_trainer_hash') * step_0.proj(transfer_step='0',
-                                                                            prev_model_fn='""', prev_model_hash='""',
-                                                                            prev_dataset_fn='""', prev_dataset_hash='""',
-                                                                            prev_trainer_fn='""', prev_trainer_hash='""')
-            return base.proj()
+        Args:
+            restrictions - restrictions on the `key_source`, as for `populate`
+            n_workers - number of worker processes. Defaults to the number of CPUs divided by `threads_per_worker`.
+            threads_per_worker - number of threads PyTorch may use in each worker.
+            poll_interval - seconds an idle worker waits before looking for new keys again
+            populate_kwargs - additional keyword arguments passed on to `populate` in each worker.
+
+        Returns
+            errors - list of (key, error message) tuples of all failed keys
+        """
+        return drain_populate(
+            self,
+            *restrictions,
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            poll_interval=poll_interval,
+            all_steps=True,
+            **populate_kwargs
+        )
+
+    def populate_steps(self, *restrictions, max_steps=None, **populate_kwargs):
+        """
+        Populates all ready transfer steps in one call, by populating step after step until a step adds no entries.
 
+        Args:
+            restrictions - restrictions on the `key_source`, as for `populate`
+            max_steps (int, optional) - maximal number of steps to populate
+            populate_kwargs - additional keyword arguments passed on to `populate`
+
+        Returns
+            errors - list of the errors returned by all populate calls
+        """
+        errors = []
+        n_steps = 0
+        while max_steps is None or n_steps < max_steps:
+            n_entries = len(self)
+            errors.extend(self.populate(*restrictions, **populate_kwargs) or [])
+            n_steps += 1
+            if len(self) == n_entries:
+                break
+        return errors
 
     def make(self, key):
         """
@@ -175,34 +275,20 @@ class TransferredTrainedModelBase(TrainedModelBase):
         # load everything
         dataloaders, model, trainer = self.load_model(key, include_trainer=True, include_state_dict=False, seed=seed)
 
-        # define callback with pinging
-        def call_back(**kwargs):
-            self.connection.ping()
-            self.call_back(**kwargs)
-
         # model training
-        score, output, model_state = trainer(model=model, dataloaders=dataloaders, seed=seed, uid=key, cb=call_back)
-
-        with tempfile.TemporaryDirectory() as temp_dir:
-            filename = make_hash(key) + '.pth.tar'
-            filepath = os.path.join(temp_dir, filename)
-            torch.save(model_state, filepath)
-
-            key['score'] = score
-            key['output'] = output
-            key['fabrikant_name'] = fabrikant_name
-            comments = []
-            comments.append((self.trainer_table & key).fetch1("trainer_comment"))
-            comments.append((self.model_table & key).fetch1("model_comment"))
-            comments.append((self.dataset_table & key).fetch1("dataset_comment"))
-            key['comment'] = self.comment_delimitter.join(comments)
-
-            key['current_model_fn'], key['current_model_hash'] = (Model & key).fetch1('model_fn', 'model_hash')
-            key['current_dataset_fn'], key['current_dataset_hash'] = (Dataset & key).fetch1('dataset_fn', 'dataset_hash')
-            key['current_trainer_fn'], key['current_trainer_hash'] = (Trainer & key).fetch1('trainer_fn', 'trainer_hash')
-
-            self.insert1(key)
-
-            key['model_state'] = filepath
-
-            self.ModelStorage.insert1(key, ignore_extra_fields=True)
\ No newline at end of file
+        score, output, model_state = self.train(dict(key), model, dataloaders, trainer, seed)
+
+        key['score'] = score
+        key['output'] = output
+        key['fabrikant_name'] = fabrikant_name
+        comments = []
+        comments.append((self.trainer_table & key).fetch1("trainer_comment"))
+        comments.append((self.model_table & key).fetch1("model_comment"))
+        comments.append((self.dataset_table & key).fetch1("dataset_comment"))
+        key['comment'] = self.comment_delimitter.join(comments)
+
+        key['current_model_fn'], key['current_model_hash'] = (Model & key).fetch1('model_fn', 'model_hash')
+        key['current_dataset_fn'], key['current_dataset_hash'] = (Dataset & key).fetch1('dataset_fn', 'dataset_hash')
+        key['current_trainer_fn'], key['current_trainer_hash'] = (Trainer & key).fetch1('trainer_fn', 'trainer_hash')
+
+        self.insert_trained_model(key, model_state)
\ No newline at end of file
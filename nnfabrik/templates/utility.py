@@ -31,6 +31,14 @@ class DataInfoBase(dj.Computed):
         )
         return definition
 
+    def compute_data_info(self, key):
+        """
+        Computes the data_info of the dataset in `key`, by calling the dataset function with `return_data_info=True`.
+        """
+        dataset_fn = resolve_data(key["dataset_fn"])
+        dataset_config = (self.dataset_table & key).fetch1("dataset_config")
+        return dataset_fn(**dataset_config, return_data_info=True)
+
     def make(self, key):
         """
         Given a dataset from nnfabrik, extracts the necessary information for building a model in nnfabrik.
@@ -46,9 +54,7 @@ class DataInfoBase(dj.Computed):
                         }
         """
 
-        dataset_fn = resolve_data(key["dataset_fn"])
-        dataset_config = (self.dataset_table & key).fetch1("dataset_config")
-        data_info = dataset_fn(**dataset_config, return_data_info=True)
+        data_info = self.compute_data_info(key)
 
         fabrikant_name = self.user_table.get_current_user()
 
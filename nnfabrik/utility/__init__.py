@@ -1,3 +1,6 @@
 from . import dj_helpers
 from . import nnf_helper
-from . import nn_helpers
\ No newline at end of file
+from . import nn_helpers
+from . import metrics
+from . import parallel
+from . import storage
@@ -1,6 +1,8 @@
 # helper functions for use with DataJoint tables
 
 import warnings
+import sys
+import math
 from datetime import datetime
 import hashlib
 import datajoint as dj
@@ -37,7 +39,124 @@ def cleanup_numpy_scalar(data):
     return data
 
 
-def make_hash(obj):
+# maximum number of digests kept in the cache of immutable objects
+HASH_CACHE_SIZE = 2 ** 16
+
+# strings longer than this are hashed directly instead of being kept in the cache
+MAX_CACHED_STR_LENGTH = 1024
+
+_hash_cache = {}
+
+# types whose `str` representation is fully determined by their value and can therefore be cached
+_CACHEABLE_TYPES = (str, int, bool, type(None))
+
+_END = object()
+
+
+def clear_hash_cache():
+    """
+    Clears the cache of digests computed for immutable (sub-)objects by `make_hash`.
+    """
+    _hash_cache.clear()
+
+
+def _cache_key(obj):
+    """
+    Returns a key for the digest cache that uniquely identifies the content of `obj`, or None if
+    `obj` is not an immutable object whose digest may be cached. The key is tagged with the types
+    of all elements, such that e.g. `(1, 2)` and `(1.0, True)` do not collide.
+    """
+    t = type(obj)
+    if t is str and len(obj) > MAX_CACHED_STR_LENGTH:
+        return None
+    if t in _CACHEABLE_TYPES:
+        return (t, obj)
+    if t is float:
+        # 0.0 == -0.0, but they are represented (and hence hashed) differently
+        return (t, obj, math.copysign(1.0, obj))
+    if t is tuple:
+        keys = tuple(_cache_key(v) for v in obj)
+        if None in keys:
+            return None
+        return (t, keys)
+    return None
+
+
+def _array_buffer(obj):
+    """
+    Returns a (type name, dtype, shape, buffer) tuple for numpy arrays and PyTorch tensors with a
+    plain (non-object) dtype, or None for all other objects. The buffer is a view onto the raw data
+    of the array and is only copied if the array is not contiguous in memory (or lives on the GPU).
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return None
+        arr = np.ascontiguousarray(obj)
+        return "ndarray", arr.dtype.str, arr.shape, arr.reshape(-1).view(np.uint8)
+
+    # only check for tensors if PyTorch is already in use, so that hashing does not import it
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(obj, torch.Tensor):
+        tensor = obj.detach().cpu().contiguous()
+        dtype = str(tensor.dtype)
+        if tensor.dtype is torch.bfloat16:
+            # numpy has no bfloat16, so look at the raw bits instead
+            tensor = tensor.view(torch.int16)
+        arr = tensor.numpy()
+        return "tensor", dtype, tuple(tensor.shape), arr.reshape(-1).view(np.uint8)
+
+    return None
+
+
+def _open(obj, stack, compat):
+    """
+    Starts hashing `obj`. Leaf objects are hashed immediately and their digest is returned. For containers,
+    a new frame is pushed onto the `stack` and None is returned; the digest is then computed once
+    all children have been hashed.
+    """
+    cache_key = _cache_key(obj)
+    if cache_key is not None:
+        digest = _hash_cache.get(cache_key)
+        if digest is not None:
+            return digest
+
+    hashed = hashlib.md5()
+    children = None
+    array = None if compat else _array_buffer(obj)
+
+    if isinstance(obj, str):
+        hashed.update(obj.encode())
+    elif array is not None:
+        kind, dtype, shape, buffer = array
+        hashed.update("{}:{}:{}:".format(kind, dtype, shape).encode())
+        hashed.update(buffer)
+    elif isinstance(obj, OrderedDict):
+        children = ((str(k).encode(), v) for k, v in obj.items())
+    elif isinstance(obj, Mapping):
+        children = ((str(k).encode(), obj[k]) for k in sorted(obj, key=str))
+    elif isinstance(obj, Iterable):
+        children = ((None, v) for v in obj)
+    else:
+        hashed.update(str(obj).encode())
+
+    if children is None:
+        digest = hashed.hexdigest()
+        _store_digest(cache_key, digest)
+        return digest
+
+    stack.append((hashed, children, cache_key))
+    return None
+
+
+def _store_digest(cache_key, digest):
+    if cache_key is None:
+        return
+    if len(_hash_cache) >= HASH_CACHE_SIZE:
+        _hash_cache.clear()
+    _hash_cache[cache_key] = digest
+
+
+def make_hash(obj, compat=None):
     """
     Given a Python object, returns a 32 character hash string to uniquely identify
     the content of the object. The object can be arbitrary nested (i.e. dictionary 
@@ -52,31 +171,48 @@ def make_hash(obj):
     intentions, key order will be ignored even in Python 3.7+ where the
     default dictionary is officially an ordered dictionary.
 
+    The object is traversed iteratively, so that deeply nested objects do not hit the recursion
+    limit, and the digests of immutable sub-objects (strings, numbers, tuples thereof) are cached.
+
+    In compatibility mode (the default), numpy arrays and PyTorch tensors are hashed element by element,
+    exactly as in previous versions, so that the hashes of existing table entries remain valid.
+    With `compat=False`, arrays and tensors are instead streamed through the digest as raw buffers
+    (together with their dtype and shape), which is much faster for large arrays. Objects that
+    contain no arrays or tensors hash identically in both modes. The default mode can be set
+    via `dj.config["nnfabrik.hash_compat"]`.
+
     Args: 
         obj - A (potentially nested) Python object
+        compat - If True, arrays and tensors are hashed element-wise, as in previous versions. If None,
+            the value of `dj.config["nnfabrik.hash_compat"]` is used, which defaults to True.
 
     Returns:
         hash: str - a 32 charcter long hash string to uniquely identify the object.
     """
-    hashed = hashlib.md5()
+    if compat is None:
+        compat = dj.config.get("nnfabrik.hash_compat", True)
+
+    stack = []
+    digest = _open(obj, stack, compat)
+    while stack:
+        hashed, children, cache_key = stack[-1]
+        if digest is not None:
+            # digest of the child that was just completed
+            hashed.update(digest.encode())
+            digest = None
+
+        prefix, child = next(children, (None, _END))
+        if child is _END:
+            stack.pop()
+            digest = hashed.hexdigest()
+            _store_digest(cache_key, digest)
+            continue
 
-    if isinstance(obj, str):
-        hashed.update(obj.encode())
-    elif isinstance(obj, OrderedDict):
-        for k, v in obj.items():
-            hashed.update(str(k).encode())
-            hashed.update(make_hash(v).encode())
-    elif isinstance(obj, Mapping):
-        for k in sorted(obj, key=str):
-            hashed.update(str(k).encode())
-            hashed.update(make_hash(obj[k]).encode())
-    elif isinstance(obj, Iterable):
-        for v in obj:
-            hashed.update(make_hash(v).encode())
-    else:
-        hashed.update(str(obj).encode())
+        if prefix is not None:
+            hashed.update(prefix)
+        digest = _open(child, stack, compat)
 
-    return hashed.hexdigest()
+    return digest
 
 
 def need_to_commit(repo, repo_name=""):
@@ -189,6 +325,8 @@ def gitlog(repos=()):
         cls.check_git = check_git
         cls.GitLog = GitLog
         cls._commits_info = None
+        # lets the table know that an entry of GitLog is inserted right after each `make`
+        cls.has_gitlog = True
 
         def alt_populate(self, *args, **kwargs):
             # the commits info must be attached to the class
@@ -365,3 +503,19 @@ class CustomSchema(Schema):
                     WrappedPartTable.__name__ = attr
                     setattr(cls, attr, WrappedPartTable)
         return super().__call__(cls, context=context)
+
+
+def connect_table(table, connection=None):
+    """
+    Returns a FreeTable of `table` on a new, separate database connection, using the credentials in dj.config.
+    Operations on the returned table are independent from any transaction that is open on the connection of
+    `table`, e.g. during `populate`, and the table can be used from a thread other than the one that created it.
+    The schema of the table is registered with the new connection, so that external attributes can be inserted.
+    Pass the `connection` of a previously returned table to put several tables on the same connection.
+    """
+    if connection is None:
+        connection = dj.Connection(
+            dj.config["database.host"], dj.config["database.user"], dj.config["database.password"]
+        )
+    Schema(table.database, connection=connection, create_schema=False, create_tables=False)
+    return dj.FreeTable(connection, table.full_table_name)
@@ -1,10 +1,79 @@
+import os
+import threading
 import numpy as np
+import multiprocessing as mp
+from concurrent.futures import wait, as_completed, FIRST_COMPLETED
 from ax.service.managed_loop import optimize
 from .nnf_helper import split_module_name, dynamic_import
+from .parallel import worker_pool, default_n_workers
 from nnfabrik.main import *
 import datajoint as dj
 
 
+def _register_config(trained_model_table, fns, config, architect, comment):
+    """
+    Adds the entries of `config` to the dataset, model and trainer tables of `trained_model_table` (if not present
+    yet), looking each of them up with a single query for the composite key of function name and config hash.
+
+    Args:
+        trained_model_table: the TrainedModel table class
+        fns (dict): names of the dataset, model and trainer functions
+        config (dict): A dictionary of dictionaries where keys are dataset, model, and trainer and the values are the
+            corresponding configs.
+        architect (str): Name of the contributor that adds the entries
+        comment (str): comment of the entries
+
+    Returns:
+        dict: key of the trained model table (without seed)
+    """
+    key = {}
+    for component in ("dataset", "model", "trainer"):
+        table = getattr(trained_model_table, component + "_table")()
+        component_key = {component + "_fn": fns[component], component + "_hash": make_hash(config[component])}
+        if not (table & component_key):
+            entry = table.add_entry(
+                fns[component],
+                config[component],
+                **{component + "_fabrikant": architect, component + "_comment": comment}
+            )
+            if entry is None:
+                raise ValueError("The {} function '{}' could not be resolved".format(component, fns[component]))
+        key.update(component_key)
+    return key
+
+
+def _mean_score(table, key):
+    """
+    Returns the score of the trained models of a trial (`key` without seed) averaged over all seeds, or None if the
+    models of some of the seeds are not trained yet.
+    """
+    scores = (table & key).fetch("score")
+    if len(scores) == 0 or len(scores) < len(table.key_source & key):
+        return None
+    return float(np.mean(scores))
+
+
+def _trial_score(table, key):
+    """Returns the score of a trial (see `_mean_score`), and raises an error if not all of its models are trained."""
+    score = _mean_score(table, key)
+    if score is None:
+        raise RuntimeError(
+            "Not all models of the trial {} are trained: their training failed, or they are reserved by another "
+            "worker (see the jobs table of the schema)".format(key)
+        )
+    return score
+
+
+def _train_trial(trained_model_table, key):
+    """
+    Trains the model of a single trial inside a worker process, and returns its score.
+    The job reservation makes sure that a model is not trained by two workers at the same time.
+    """
+    table = trained_model_table()
+    table.populate(key, reserve_jobs=True)
+    return _trial_score(table, key)
+
+
 class Bayesian:
     """
     A hyperparameter optimization tool based on Facebook Ax (https://ax.dev/), integrated with nnfabrik.
@@ -28,6 +97,12 @@ class Bayesian:
         total_trials (int, optional): Number of experiments (i.e. training) to run. Defaults to 5.
         arms_per_trial (int, optional): Number of different configurations used for training (for more details check https://ax.dev/docs/glossary.html#trial). Defaults to 1.
         comment (str, optional): Comments about this optimization round. It will be used to fill up the comment entry of dataset, model, and trainer table. Defaults to "Bayesian optimization of Hyper params.".
+        state_path (str, optional): path of a JSON file the state of the search is saved to after every change. If the
+            file exists, the search resumes from it, and `total_trials` counts the trials of earlier runs as well.
+            Defaults to None, i.e. the state is not saved.
+        warm_start (bool, optional): if True, a new search is seeded with the scores of all models in the trained
+            model table whose configurations lie in the search space (averaged over seeds). These trials do not count
+            towards `total_trials`. Defaults to False.
     """
 
     def __init__(
@@ -46,6 +121,8 @@ class Bayesian:
         total_trials=5,
         arms_per_trial=1,
         comment="Bayesian optimization of Hyper params.",
+        state_path=None,
+        warm_start=False,
     ):
 
         self.fns = dict(dataset=dataset_fn, model=model_fn, trainer=trainer_fn)
@@ -55,6 +132,8 @@ class Bayesian:
         self.total_trials = total_trials
         self.arms_per_trial = arms_per_trial
         self.comment = comment
+        self.state_path = state_path
+        self.warm_start = warm_start
 
         # import TrainedModel definition
         module_path, class_name = split_module_name(trained_model_table)
@@ -133,7 +212,7 @@ class Bayesian:
         keys = ["dataset", "model", "trainer"]
         params = {}
         for key in keys:
-            params[key] = fixed_params[key]
+            params[key] = dict(fixed_params[key])
             params[key].update(auto_params[key])
 
         return {key: params[key] for key in keys}
@@ -168,63 +247,196 @@ class Bayesian:
         Returns:
             float: the score of the trained model for the specific entry in trained model table
         """
+        key = self.register(auto_params)
+
+        # populate the table for those primary keys
+        self.trained_model_table().populate(key)
+
+        # get the score of the model for this specific set of hyperparameters, averaged over all seeds
+        return _trial_score(self.trained_model_table(), key)
+
+    def register(self, auto_params):
+        """
+        For a given set of parameters, add an entry to the dataset, model and trainer tables (if not present yet).
+
+        Args:
+            auto_params (dict): dictionary of the values of the parameters in the search space.
+
+        Returns:
+            dict: key of the trained model table (without seed) of the entries of the given parameters
+        """
         config = self._combine_params(self._split_config(auto_params), self.fixed_params)
+        return _register_config(self.trained_model_table, self.fns, config, self.architect, self.comment)
 
-        # insert the stuff into their corresponding tables
-        dataset_hash = make_hash(config["dataset"])
-        entry_exists = (
-            {"dataset_fn": "{}".format(self.fns["dataset"])} in self.trained_model_table.dataset_table()
-            and {"dataset_hash": "{}".format(dataset_hash)} in self.trained_model_table.dataset_table()
-        )
-        if not entry_exists:
-            self.trained_model_table.dataset_table().add_entry(
-                self.fns["dataset"], config["dataset"], dataset_fabrikant=self.architect, dataset_comment=self.comment
-            )
+    def fetch_score(self, key):
+        """Returns the score of a trial averaged over all seeds, or None if it is not trained yet."""
+        return _mean_score(self.trained_model_table(), key)
 
-        model_hash = make_hash(config["model"])
-        entry_exists = {"model_fn": "{}".format(self.fns["model"])} in self.trained_model_table.model_table() and {
-            "model_hash": "{}".format(model_hash)
-        } in self.trained_model_table.model_table()
-        if not entry_exists:
-            self.trained_model_table.model_table().add_entry(
-                self.fns["model"], config["model"], model_fabrikant=self.architect, model_comment=self.comment
-            )
+    def ax_client(self, enforce_sequential_optimization=True):
+        """
+        Returns the AxClient of the search, loaded from `state_path` if that file exists, or with a new experiment.
+        """
+        from ax.service.ax_client import AxClient
 
-        trainer_hash = make_hash(config["trainer"])
-        entry_exists = (
-            {"trainer_fn": "{}".format(self.fns["trainer"])} in self.trained_model_table.trainer_table()
-            and {"trainer_hash": "{}".format(trainer_hash)} in self.trained_model_table.trainer_table()
-        )
-        if not entry_exists:
-            self.trained_model_table.trainer_table().add_entry(
-                self.fns["trainer"], config["trainer"], trainer_fabrikant=self.architect, trainer_comment=self.comment
-            )
+        if self.state_path is not None and os.path.exists(self.state_path):
+            return AxClient.load_from_json_file(filepath=self.state_path)
 
-        # get the primary key values for all those entries
-        restriction = (
-            'dataset_fn in ("{}")'.format(self.fns["dataset"]),
-            'dataset_hash in ("{}")'.format(dataset_hash),
-            'model_fn in ("{}")'.format(self.fns["model"]),
-            'model_hash in ("{}")'.format(model_hash),
-            'trainer_fn in ("{}")'.format(self.fns["trainer"]),
-            'trainer_hash in ("{}")'.format(trainer_hash),
-        )
+        ax_client = AxClient(enforce_sequential_optimization=enforce_sequential_optimization)
+        ax_client.create_experiment(parameters=self.auto_params, objective_name="val_corr", minimize=False)
+        if self.warm_start:
+            self.attach_trained_models(ax_client)
+        self.save_state(ax_client)
+        return ax_client
 
-        # populate the table for those primary keys
-        self.trained_model_table().populate(*restriction)
+    def decode_configs(self, configs):
+        """
+        Reverses `_combine_params`: returns the values of the parameters of the search space for the given dataset,
+        model and trainer configs, or None if the configs differ from the fixed parameters or lie outside of the
+        search space.
+
+        Args:
+            configs (dict): A dictionary of dictionaries where keys are dataset, model, and trainer and the values are
+                the corresponding configs.
+
+        Returns:
+            dict: the values of the parameters, in the format of `auto_params`
+        """
+        for component in ("dataset", "model", "trainer"):
+            auto_names = {
+                param["name"].split(".")[1] for param in self.auto_params if param["name"].split(".")[0] == component
+            }
+            fixed = self.fixed_params[component]
+            config = configs[component]
+            if set(config) != set(fixed) | auto_names:
+                return None
+            if not all(np.array_equal(config[k], v) for k, v in fixed.items() if k not in auto_names):
+                return None
+
+        params = {}
+        for param in self.auto_params:
+            component, name = param["name"].split(".")
+            value = configs[component][name]
+            if param["type"] == "fixed":
+                if not np.array_equal(value, param["value"]):
+                    return None
+                value = param["value"]
+            elif param["type"] == "choice":
+                matches = [v for v in param["values"] if np.array_equal(value, v)]
+                if not matches:
+                    return None
+                value = matches[0]
+            else:
+                low, high = param["bounds"]
+                if not low <= value <= high:
+                    return None
+                value = int(value) if param.get("value_type") == "int" else float(value)
+            params[param["name"]] = value
+        return params
+
+    def attach_trained_models(self, ax_client):
+        """
+        Attaches the trained models of the same dataset, model and trainer functions whose configurations lie in the
+        search space as completed trials to the experiment of `ax_client`. All models are fetched with a single
+        query, and the scores of models that only differ in their seed are averaged.
 
-        # get the score of the model for this specific set of hyperparameters
-        score = (self.trained_model_table() & dj.AndList(restriction)).fetch("score")[0]
+        Returns:
+            int: the number of attached trials
+        """
+        table = self.trained_model_table
+        rows = (
+            table().proj("score")
+            * (table.dataset_table() & dict(dataset_fn=self.fns["dataset"])).proj("dataset_config")
+            * (table.model_table() & dict(model_fn=self.fns["model"])).proj("model_config")
+            * (table.trainer_table() & dict(trainer_fn=self.fns["trainer"])).proj("trainer_config")
+        ).fetch(as_dict=True)
+
+        # scores of all seeds, by configuration
+        scores = {}
+        for row in rows:
+            config_hash = (row["dataset_hash"], row["model_hash"], row["trainer_hash"])
+            if config_hash not in scores:
+                configs = {component: row[component + "_config"] for component in ("dataset", "model", "trainer")}
+                scores[config_hash] = (self.decode_configs(configs), [])
+            scores[config_hash][1].append(row["score"])
+
+        n_attached = 0
+        for params, config_scores in scores.values():
+            if params is None:
+                continue
+            _, trial_index = ax_client.attach_trial(parameters=params)
+            ax_client.experiment.trials[trial_index].update_run_metadata(dict(warm_start=True))
+            ax_client.complete_trial(trial_index=trial_index, raw_data=float(np.mean(config_scores)))
+            n_attached += 1
+        return n_attached
 
-        return score
+    @staticmethod
+    def n_trials(ax_client):
+        """Returns the number of trials of the experiment of `ax_client`, apart from the ones from the warm start."""
+        return sum(not trial.run_metadata.get("warm_start") for trial in ax_client.experiment.trials.values())
+
+    def save_state(self, ax_client):
+        """Saves the experiment and the generation strategy of `ax_client` to `state_path` (if set)."""
+        if self.state_path is None:
+            return
+        # write to a temporary file first, so that a crash while saving does not corrupt the last state
+        temp_path = self.state_path + ".tmp"
+        ax_client.save_to_json_file(filepath=temp_path)
+        os.replace(temp_path, self.state_path)
+
+    def resume(self, ax_client):
+        """
+        Re-attaches the trials that were still running when the state was saved: trials whose models have been
+        trained in the meantime are completed with the score from the trained model table, the others are returned.
+
+        Returns:
+            list: (trial_index, parameters) of the trials that still have to be trained
+        """
+        unfinished = []
+        for trial_index, trial in ax_client.experiment.trials.items():
+            if not trial.status.is_running:
+                continue
+            parameters = trial.arm.parameters
+            score = self.fetch_score(self.register(parameters))
+            if score is None:
+                unfinished.append((trial_index, parameters))
+            else:
+                ax_client.complete_trial(trial_index=trial_index, raw_data=float(score))
+        self.save_state(ax_client)
+        return unfinished
+
+    def run_resumable(self):
+        """
+        Runs Bayesian optimization with the service API of Ax, one trial at a time, and saves the state of the search
+        to `state_path` after every change. Every trial has a single arm.
+
+        Returns:
+            tuple: The best parameters, their predicted values, the experiment and the AxClient
+        """
+        ax_client = self.ax_client()
+        trials = self.resume(ax_client)
+        while trials or self.n_trials(ax_client) < self.total_trials:
+            if not trials:
+                parameters, trial_index = ax_client.get_next_trial()
+                self.save_state(ax_client)
+                trials = [(trial_index, parameters)]
+            trial_index, parameters = trials.pop(0)
+            score = self.train_evaluate(parameters)
+            ax_client.complete_trial(trial_index=trial_index, raw_data=float(score))
+            self.save_state(ax_client)
+
+        best_parameters, values = ax_client.get_best_parameters()
+        return self._split_config(best_parameters), values, ax_client.experiment, ax_client
 
     def run(self):
         """
-        Runs Bayesian optimization.
+        Runs Bayesian optimization. If `state_path` or `warm_start` is set, runs `run_resumable` instead.
 
         Returns:
             tuple: The returned values are similar to that of Ax (refer to https://ax.dev/docs/api.html)
         """
+        if self.state_path is not None or self.warm_start:
+            return self.run_resumable()
+
         best_parameters, values, experiment, model = optimize(
             parameters=self.auto_params,
             evaluation_function=self.train_evaluate,
@@ -236,6 +448,66 @@ class Bayesian:
 
         return self._split_config(best_parameters), values, experiment, model
 
+    def run_async(self, n_workers=None, batch_size=None, threads_per_worker=None, start_method="spawn"):
+        """
+        Runs Bayesian optimization with several trials trained at the same time, based on the service API of Ax.
+        Whenever workers are idle, up to `batch_size` new candidates are generated at once and handed to a pool of
+        worker processes. The result of every trial is reported back to Ax as soon as it completes, so that the next
+        candidates already take it into account. If `state_path` is set, the state of the search is saved after every
+        change, and trials that were running when the state was saved are resumed first.
+
+        The trained model table has to be importable by its module path (see `nnfabrik.utility.parallel`).
+
+        Args:
+            n_workers (int, optional): number of trials trained at the same time. Defaults to the number of CPUs
+                divided by `threads_per_worker`.
+            batch_size (int, optional): maximal number of candidates generated at once. Defaults to `n_workers`.
+            threads_per_worker (int, optional): number of threads PyTorch may use in each worker.
+            start_method (str, optional): multiprocessing start method of the workers.
+
+        Returns:
+            tuple: The best parameters, their predicted values, the experiment and the AxClient
+        """
+        from ax.exceptions.core import DataRequiredError
+        from ax.exceptions.generation_strategy import MaxParallelismReachedException
+
+        if n_workers is None:
+            n_workers = default_n_workers(threads_per_worker)
+        batch_size = batch_size or n_workers
+
+        ax_client = self.ax_client(enforce_sequential_optimization=False)
+
+        pending = {}
+        with worker_pool(n_workers, threads_per_worker, start_method) as executor:
+            for trial_index, parameters in self.resume(ax_client):
+                pending[executor.submit(_train_trial, self.trained_model_table, self.register(parameters))] = trial_index
+
+            while self.n_trials(ax_client) < self.total_trials or pending:
+                n_new = min(batch_size, self.total_trials - self.n_trials(ax_client), n_workers - len(pending))
+                for _ in range(n_new):
+                    try:
+                        parameters, trial_index = ax_client.get_next_trial()
+                    except (DataRequiredError, MaxParallelismReachedException):
+                        # the generation strategy may require more completed trials before it generates new ones
+                        if not pending:
+                            raise
+                        break
+                    key = self.register(parameters)
+                    pending[executor.submit(_train_trial, self.trained_model_table, key)] = trial_index
+                self.save_state(ax_client)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial_index = pending.pop(future)
+                    if future.exception() is None:
+                        ax_client.complete_trial(trial_index=trial_index, raw_data=float(future.result()))
+                    else:
+                        ax_client.log_trial_failure(trial_index=trial_index)
+                self.save_state(ax_client)
+
+        best_parameters, values = ax_client.get_best_parameters()
+        return self._split_config(best_parameters), values, ax_client.experiment, ax_client
+
 
 class Random:
     """
@@ -258,6 +530,10 @@ class Random:
         trained_model_table (str): name (importable) of the trained_model_table
         total_trials (int, optional): Number of experiments (i.e. training) to run. Defaults to 5.
         comment (str, optional): Comments about this optimization round. It will be used to fill up the comment entry of dataset, model, and trainer table. Defaults to "Bayesian optimization of Hyper params.".
+        seed (int, optional): seed of the random number generator, for reproducible searches. Defaults to None.
+        sampler (str, optional): how the points in the search space are drawn. "random" samples independently,
+            "sobol" and "lhs" draw a scrambled Sobol sequence or a latin hypercube (requires scipy), which cover
+            the search space more evenly. Defaults to "random".
     """
 
     def __init__(
@@ -275,6 +551,8 @@ class Random:
         trained_model_table,
         total_trials=5,
         comment="Random search for hyper params.",
+        seed=None,
+        sampler="random",
     ):
 
         self.fns = dict(dataset=dataset_fn, model=model_fn, trainer=trainer_fn)
@@ -283,6 +561,10 @@ class Random:
         self.architect = architect
         self.total_trials = total_trials
         self.comment = comment
+        self.rng = np.random.default_rng(seed)
+        if sampler not in ("random", "sobol", "lhs"):
+            raise ValueError("sampler has to be one of 'random', 'sobol' or 'lhs', not '{}'".format(sampler))
+        self.sampler = sampler
 
         # import TrainedModel definition
         module_path, class_name = split_module_name(trained_model_table)
@@ -356,7 +638,7 @@ class Random:
         keys = ["dataset", "model", "trainer"]
         params = {}
         for key in keys:
-            params[key] = fixed_params[key]
+            params[key] = dict(fixed_params[key])
             params[key].update(auto_params[key])
 
         return {key: params[key] for key in keys}
@@ -389,50 +671,107 @@ class Random:
             auto_params (dict): list of dictionaries where each dictionary specifies a single parameter to be sampled.
 
         """
+        self.populate(self.register(auto_params))
+
+    def register(self, auto_params):
+        """
+        For a given set of parameters, add an entry to the dataset, model and trainer tables (if not present yet).
+
+        Args:
+            auto_params (dict): dictionary of the values of the parameters in the search space.
+
+        Returns:
+            dict: key of the trained model table (without seed) of the entries of the given parameters
+        """
         config = self._combine_params(self._split_config(auto_params), self.fixed_params)
+        return _register_config(self.trained_model_table, self.fns, config, self.architect, self.comment)
 
-        # insert the stuff into their corresponding tables
-        dataset_hash = make_hash(config["dataset"])
-        entry_exists = (
-            {"dataset_fn": "{}".format(self.fns["dataset"])} in self.trained_model_table.dataset_table()
-            and {"dataset_hash": "{}".format(dataset_hash)} in self.trained_model_table.dataset_table()
-        )
-        if not entry_exists:
-            self.trained_model_table.dataset_table().add_entry(
-                self.fns["dataset"], config["dataset"], dataset_fabrikant=self.architect, dataset_comment=self.comment
-            )
+    def populate(self, restriction):
+        """
+        Populates the trained model table for the given restriction (a key, or a list of keys), i.e. trains the models
+        of the trials. Override this method to change how the models are trained.
+        """
+        self.trained_model_table().populate(restriction)
 
-        model_hash = make_hash(config["model"])
-        entry_exists = {"model_fn": "{}".format(self.fns["model"])} in self.trained_model_table.model_table() and {
-            "model_hash": "{}".format(model_hash)
-        } in self.trained_model_table.model_table()
-        if not entry_exists:
-            self.trained_model_table.model_table().add_entry(
-                self.fns["model"], config["model"], model_fabrikant=self.architect, model_comment=self.comment
-            )
+    def register_all(self, auto_params_list):
+        """
+        Bulk version of `register`: adds the entries for all given sets of parameters to the dataset, model and
+        trainer tables with a single lookup and a single insert per table.
 
-        trainer_hash = make_hash(config["trainer"])
-        entry_exists = (
-            {"trainer_fn": "{}".format(self.fns["trainer"])} in self.trained_model_table.trainer_table()
-            and {"trainer_hash": "{}".format(trainer_hash)} in self.trained_model_table.trainer_table()
-        )
-        if not entry_exists:
-            self.trained_model_table.trainer_table().add_entry(
-                self.fns["trainer"], config["trainer"], trainer_fabrikant=self.architect, trainer_comment=self.comment
+        Args:
+            auto_params_list (list): list of parameter dictionaries, as returned by `sample`
+
+        Returns:
+            list: keys of the trained model table (without seed) for the given parameters, in the same order
+        """
+        configs = [self._combine_params(self._split_config(params), self.fixed_params) for params in auto_params_list]
+        keys = [{} for _ in configs]
+        for component in ("dataset", "model", "trainer"):
+            table = getattr(self.trained_model_table, component + "_table")()
+            entries = table.add_entries(
+                self.fns[component],
+                [config[component] for config in configs],
+                skip_duplicates=True,
+                **{component + "_fabrikant": self.architect, component + "_comment": self.comment}
             )
+            if entries is None:
+                raise ValueError("The {} function '{}' could not be resolved".format(component, self.fns[component]))
+            for key, entry in zip(keys, entries):
+                key.update({attr: entry[attr] for attr in (component + "_fn", component + "_hash")})
+        return keys
+
+    def _unit_samples(self, n, dims):
+        """Returns `n` points in the unit hypercube of dimension `dims`, drawn with the configured sampler."""
+        if self.sampler == "random" or dims == 0:
+            return self.rng.random((n, dims))
+        from scipy.stats import qmc
+
+        if self.sampler == "sobol":
+            return qmc.Sobol(dims, scramble=True, seed=self.rng).random(n)
+        return qmc.LatinHypercube(dims, seed=self.rng).random(n)
+
+    def sample(self, n):
+        """
+        Draws `n` sets of values for the parameters at once. Ranges are sampled uniformly (in log space if
+        "log_scale" is set, and rounded down to integers if "value_type" is "int"), choices with equal probability.
 
-        # get the primary key values for all those entries
-        restriction = (
-            'dataset_fn in ("{}")'.format(self.fns["dataset"]),
-            'dataset_hash in ("{}")'.format(dataset_hash),
-            'model_fn in ("{}")'.format(self.fns["model"]),
-            'model_hash in ("{}")'.format(model_hash),
-            'trainer_fn in ("{}")'.format(self.fns["trainer"]),
-            'trainer_hash in ("{}")'.format(trainer_hash),
-        )
+        Args:
+            n (int): number of parameter sets
 
-        # populate the table for those primary keys
-        self.trained_model_table().populate(*restriction)
+        Returns:
+            list: list of `n` dictionaries containing the parameters whose values should be sampled.
+        """
+        sampled = [param for param in self.auto_params if param["type"] in ("range", "choice")]
+        unit = self._unit_samples(n, len(sampled))
+
+        values = {}
+        for param, u in zip(sampled, unit.T):
+            if param["type"] == "choice":
+                indices = np.minimum((u * len(param["values"])).astype(int), len(param["values"]) - 1)
+                values[param["name"]] = [param["values"][i] for i in indices]
+                continue
+            low, high = param["bounds"]
+            if param.get("value_type") == "int":
+                # every integer in [low, high] gets the same share of the unit interval
+                low, high = (np.log(low), np.log(high + 1)) if param.get("log_scale") else (low, high + 1)
+                v = low + u * (high - low)
+                v = np.exp(v) if param.get("log_scale") else v
+                values[param["name"]] = [int(x) for x in np.minimum(np.floor(v), param["bounds"][1])]
+            elif param.get("log_scale"):
+                values[param["name"]] = np.exp(np.log(low) + u * (np.log(high) - np.log(low))).tolist()
+            else:
+                values[param["name"]] = (low + u * (high - low)).tolist()
+
+        samples = []
+        for i in range(n):
+            auto_params_val = {}
+            for param in self.auto_params:
+                if param["type"] == "fixed":
+                    auto_params_val[param["name"]] = param["value"]
+                elif param["name"] in values:
+                    auto_params_val[param["name"]] = values[param["name"]][i]
+            samples.append(auto_params_val)
+        return samples
 
     def gen_params_value(self):
         """
@@ -441,23 +780,250 @@ class Random:
         Returns:
             dict: A dictionary containing the parameters whose values should be sampled.
         """
-        np.random.seed(None)
-        auto_params_val = {}
-        for param in self.auto_params:
-            if param["type"] == "fixed":
-                auto_params_val.update({param["name"]: param["value"]})
-            elif param["type"] == "choice":
-                auto_params_val.update({param["name"]: np.random.choice(param["values"])})
-            elif param["type"] == "range":
-                auto_params_val.update({param["name"]: np.random.uniform(*param["bounds"])})
-
-        return auto_params_val
+        return self.sample(1)[0]
 
     def run(self):
         """
-        Runs the random hyperparameter search, for as many trials as specified.
+        Runs the random hyperparameter search, for as many trials as specified. All configurations are sampled and
+        registered up front, and trained with a single populate, so that several workers populating the trained
+        model table (e.g. with `reserve_jobs=True`) can train them in parallel.
+        """
+        keys = self.register_all(self.sample(self.total_trials))
+        self.populate(keys)
+
+
+class TrialStopped(Exception):
+    """Raised from the callback of a training to stop a trial early."""
+
+    def __init__(self, epoch, score):
+        super().__init__(epoch, score)
+        self.epoch = epoch
+        self.score = score
+
+    def __str__(self):
+        return "Trial stopped at epoch {} with score {}".format(self.epoch, self.score)
+
+
+def _promote(scores, score, eta, minimize):
+    """Returns True if `score` is among the top `1 / eta` of `scores` (which include `score`)."""
+    if len(scores) < eta:
+        return True
+    sign = -1 if minimize else 1
+    cutoff = np.percentile(sign * np.array(scores), 100 * (1 - 1 / eta))
+    return sign * score >= cutoff
+
+
+class RungCallBack:
+    """
+    Training callback of an ASHA search, passed to `populate` of the trained model table. At every rung of the bracket
+    of the trial under training, it records the score, and stops the training (raises TrialStopped) unless the score
+    is among the top `1 / eta` of all scores recorded at this rung so far. The trial, and hence the bracket, is looked
+    up by the key of the trained model (`uid`), such that trials can be trained in any order and in several processes.
+
+    Args:
+        trial_brackets (dict): bracket of every trial, by the hash of the key of the trial (see `trial_hash`)
+        rungs (list): epochs of the rungs of every bracket
+        eta (int): reduction factor between rungs
+        minimize (bool): if True, lower scores are better
+        score_fn (callable): function computing the score of a model, if the trainer does not report it
+        rung_scores (dict): scores of all trials by (bracket, epoch). May be a dict proxy shared among processes.
+        lock: lock guarding `rung_scores`. May be a lock proxy shared among processes.
+    """
+
+    def __init__(self, trial_brackets, rungs, eta, minimize, score_fn, rung_scores, lock):
+        self.trial_brackets = trial_brackets
+        self.rungs = [set(epochs) for epochs in rungs]
+        self.eta = eta
+        self.minimize = minimize
+        self.score_fn = score_fn
+        self.rung_scores = rung_scores
+        self.lock = lock
+
+    @staticmethod
+    def trial_hash(key):
+        """Returns the hash of the dataset, model and trainer of `key`, i.e. of the trial without seed."""
+        return make_hash({k: key[k] for k in key if k.endswith("_fn") or k.endswith("_hash")})
+
+    def __call__(self, uid=None, epoch=None, model=None, info=None):
+        bracket = self.trial_brackets[self.trial_hash(uid)]
+        if epoch not in self.rungs[bracket]:
+            return
+        score = (info or {}).get("score")
+        if score is None:
+            if self.score_fn is None:
+                raise ValueError("The trainer has to report the score as `info['score']`, or `score_fn` has to be set")
+            score = self.score_fn(model)
+
+        with self.lock:
+            # lists in shared dicts are copies, hence the scores are replaced instead of appended to
+            scores = list(self.rung_scores.get((bracket, epoch), [])) + [score]
+            self.rung_scores[(bracket, epoch)] = scores
+        if not _promote(scores, score, self.eta, self.minimize):
+            raise TrialStopped(epoch, score)
+
+
+def _train_asha_trial(trained_model_table, key, call_back):
+    """
+    Trains the models of an ASHA trial (in a worker process), and returns the epoch it was stopped at (or None) and
+    its score. Stopped trainings are recorded as errors in the jobs table. The score is None if the trial was stopped,
+    or if it was skipped because of a job of an earlier search.
+    """
+    table = trained_model_table()
+    errors = table.populate(
+        key, call_back=call_back, reserve_jobs=True, suppress_errors=True, return_exception_objects=True
+    )
+    stopped = []
+    for _, error in errors or []:
+        if not isinstance(error, TrialStopped):
+            raise error
+        stopped.append(error.epoch)
+    if stopped:
+        return dict(stopped_at=min(stopped), score=None)
+    return dict(stopped_at=None, score=_mean_score(table, key))
+
+
+class ASHA(Random):
+    """
+    Asynchronous successive halving (ASHA) and its Hyperband-like extension to several brackets, integrated with nnfabrik.
+    Configurations are sampled as in the Random search, but instead of training every configuration to completion,
+    trainings are stopped early once they perform worse than most trials at the same stage of training.
+
+    The training of every trial passes through rungs at epochs `min_epochs * eta ** k` (up to `max_epochs`). At each
+    rung, the score of the trial is compared to the scores all trials had so far at the same rung: trials outside of
+    the top `1 / eta` fraction are stopped, the others are promoted to the next rung, i.e. continue training. With
+    `brackets > 1`, trials are assigned to the brackets in turn, and the rungs of bracket b start at `min_epochs * eta ** b`,
+    which hedges against stopping trials that only do well after longer training (as in Hyperband).
+
+    The intermediate scores are obtained from the callback that `TrainedModelBase.make` hands to the trainer as `cb`.
+    The trainer has to call it at the end of every epoch as `cb(epoch=epoch, model=model, info=dict(score=score))`,
+    where `epoch` counts from 1. Alternatively, `score_fn(model)` computes the score from the model.
+
+    With `n_workers > 1`, trials are trained by a pool of worker processes, and every decision at a rung takes the
+    scores of all trials into account that reached the rung so far, no matter which worker trained them. Trials
+    that are stopped early have no entry in the trained model table. Instead, their stops are recorded as errors in
+    the jobs table of the schema, such that later populate calls with `reserve_jobs=True` (e.g. `parallel_populate`)
+    skip them. Delete their jobs to train them to completion.
+
+    Args:
+        see `Random` for all arguments but the following.
+        max_epochs (int): number of epochs of a trial that is never stopped, as set in the trainer config
+        min_epochs (int, optional): epoch of the first rung. Defaults to 1.
+        eta (int, optional): reduction factor between rungs. Defaults to 3.
+        brackets (int, optional): number of brackets. Defaults to 1, i.e. plain successive halving.
+        minimize (bool, optional): if True, lower scores are better. Defaults to False.
+        score_fn (callable, optional): function computing the score of a model, if the trainer does not report it.
+            Has to be importable by its module path if `n_workers > 1`.
+    """
+
+    def __init__(
+        self,
+        dataset_fn,
+        dataset_config,
+        dataset_config_auto,
+        model_fn,
+        model_config,
+        model_config_auto,
+        trainer_fn,
+        trainer_config,
+        trainer_config_auto,
+        architect,
+        trained_model_table,
+        max_epochs,
+        total_trials=5,
+        comment="ASHA search for hyper params.",
+        seed=None,
+        sampler="random",
+        min_epochs=1,
+        eta=3,
+        brackets=1,
+        minimize=False,
+        score_fn=None,
+    ):
+        super().__init__(
+            dataset_fn,
+            dataset_config,
+            dataset_config_auto,
+            model_fn,
+            model_config,
+            model_config_auto,
+            trainer_fn,
+            trainer_config,
+            trainer_config_auto,
+            architect,
+            trained_model_table,
+            total_trials=total_trials,
+            comment=comment,
+            seed=seed,
+            sampler=sampler,
+        )
+        self.max_epochs = max_epochs
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.brackets = brackets
+        self.minimize = minimize
+        self.score_fn = score_fn
+
+        # scores of all trials by (bracket, epoch of the rung)
+        self.rung_scores = {}
+        # one dictionary per trial with its parameters, key, bracket, final score and the epoch it was stopped at
+        self.trials = []
+
+    def rungs(self, bracket):
+        """Returns the epochs of the rungs of `bracket`."""
+        rungs = []
+        epoch = self.min_epochs * self.eta ** bracket
+        while epoch < self.max_epochs:
+            rungs.append(epoch)
+            epoch *= self.eta
+        return rungs
+
+    def rung_call_back(self, rung_scores, lock):
+        """Returns the RungCallBack for the current trials, recording the scores in `rung_scores`."""
+        trial_brackets = {RungCallBack.trial_hash(trial["key"]): trial["bracket"] for trial in self.trials}
+        rungs = [self.rungs(bracket) for bracket in range(self.brackets)]
+        return RungCallBack(trial_brackets, rungs, self.eta, self.minimize, self.score_fn, rung_scores, lock)
+
+    def run(self, n_workers=1, threads_per_worker=None, start_method="spawn"):
+        """
+        Runs the search for as many trials as specified. All configurations are sampled and registered up front.
+
+        Args:
+            n_workers (int, optional): number of trials trained at the same time. If 1 (the default), the trials are
+                trained one after another in this process.
+            threads_per_worker, start_method: see `nnfabrik.utility.parallel.parallel_populate`
+
+        Returns:
+            tuple: the parameters and the score of the best trial that was trained to completion (or None), and the
+            list of all trials
         """
-        n_trials = len(self.trained_model_table.seed_table()) * self.total_trials
-        init_len = len(self.trained_model_table())
-        while len(self.trained_model_table()) - init_len < n_trials:
-            self.train_evaluate(self.gen_params_value())
+        params = self.sample(self.total_trials)
+        keys = self.register_all(params)
+        # configurations that were sampled more than once are only trained once
+        unique = {RungCallBack.trial_hash(key): (p, key) for p, key in zip(params, keys)}
+        self.trials = [
+            dict(params=p, key=key, bracket=i % self.brackets, score=None, stopped_at=None)
+            for i, (p, key) in enumerate(unique.values())
+        ]
+
+        if n_workers == 1:
+            call_back = self.rung_call_back({}, threading.Lock())
+            for trial in self.trials:
+                trial.update(_train_asha_trial(self.trained_model_table, trial["key"], call_back))
+            self.rung_scores = dict(call_back.rung_scores)
+        else:
+            with mp.get_context(start_method).Manager() as manager:
+                call_back = self.rung_call_back(manager.dict(), manager.Lock())
+                with worker_pool(n_workers, threads_per_worker, start_method) as executor:
+                    futures = {
+                        executor.submit(_train_asha_trial, self.trained_model_table, trial["key"], call_back): trial
+                        for trial in self.trials
+                    }
+                    for future in as_completed(futures):
+                        futures[future].update(future.result())
+                self.rung_scores = dict(call_back.rung_scores)
+
+        completed = [trial for trial in self.trials if trial["score"] is not None]
+        if not completed:
+            return None, self.trials
+        best = (min if self.minimize else max)(completed, key=lambda trial: trial["score"])
+        return (self._split_config(best["params"]), best["score"]), self.trials
@@ -0,0 +1,325 @@
+# helper functions for computing metrics of trained models in a single pass over the data
+
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+from neuralpredictors.training import eval_state
+
+
+def to_numpy(x):
+    """Converts a torch tensor (or any array-like object) into a numpy array."""
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+class Accumulator:
+    """
+    Base class for metrics that are computed in a single pass over the data. An accumulator is fed with
+    batches of model outputs and targets via `update`, and returns the score per unit from `compute`.
+    Accumulators for disjoint parts of the data can be combined with `merge`, which allows computing
+    a metric on several shards of the data in parallel.
+
+    Subclasses keep sufficient statistics of the data seen so far, instead of the data itself.
+    """
+
+    def update(self, outputs, targets):
+        """
+        Accumulates a batch.
+
+        Args:
+            outputs (np.array): model outputs of shape (batch, units), or None for metrics of the data alone
+            targets (np.array): targets of shape (batch, units)
+        """
+        raise NotImplementedError("Accumulators have to implement `update`")
+
+    def merge(self, other):
+        """Merges the statistics of `other` (accumulated on different data) into this accumulator and returns it."""
+        raise NotImplementedError("Accumulators have to implement `merge`")
+
+    def compute(self):
+        """Returns the scores per unit (np.array) of all data accumulated so far."""
+        raise NotImplementedError("Accumulators have to implement `compute`")
+
+
+def _as_2d(x):
+    """Flattens all but the last (unit) dimension of `x`, and converts it to float64."""
+    x = np.asarray(x, dtype=np.float64)
+    return x.reshape(-1, x.shape[-1]) if x.ndim > 1 else x.reshape(-1, 1)
+
+
+def _merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Combines count, mean and sum of squared deviations of two disjoint sets of samples (Chan et al.)."""
+    n = n_a + n_b
+    if n == 0:
+        return n, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+class Moments(Accumulator):
+    """
+    Running count, mean and sum of squared deviations (Welford) of the targets per unit.
+    Used as building block of the other accumulators, and computes the variance of the targets.
+
+    Args:
+        ddof (int): delta degrees of freedom of the variance
+    """
+
+    def __init__(self, ddof=1):
+        self.ddof = ddof
+        self.n, self.mean, self.m2 = 0, 0.0, 0.0
+
+    def add(self, x):
+        x = _as_2d(x)
+        self.n, self.mean, self.m2 = _merge_moments(
+            self.n, self.mean, self.m2, len(x), x.mean(axis=0), ((x - x.mean(axis=0)) ** 2).sum(axis=0)
+        )
+
+    def update(self, outputs, targets):
+        self.add(targets)
+
+    def merge(self, other):
+        self.n, self.mean, self.m2 = _merge_moments(self.n, self.mean, self.m2, other.n, other.mean, other.m2)
+        return self
+
+    def compute(self):
+        return self.m2 / (self.n - self.ddof)
+
+
+class Correlation(Accumulator):
+    """
+    Pearson correlation between outputs and targets per unit, from running means, variances and covariances.
+
+    Args:
+        eps (float): added to the standard deviations to avoid division by zero
+    """
+
+    def __init__(self, eps=1e-8):
+        self.eps = eps
+        self.n, self.mean_x, self.mean_y, self.m2_x, self.m2_y, self.c_xy = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+
+    def _combine(self, n, mean_x, mean_y, m2_x, m2_y, c_xy):
+        n_total = self.n + n
+        if n_total == 0:
+            return
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        self.c_xy = self.c_xy + c_xy + delta_x * delta_y * self.n * n / n_total
+        _, self.mean_x, self.m2_x = _merge_moments(self.n, self.mean_x, self.m2_x, n, mean_x, m2_x)
+        self.n, self.mean_y, self.m2_y = _merge_moments(self.n, self.mean_y, self.m2_y, n, mean_y, m2_y)
+
+    def update(self, outputs, targets):
+        x, y = _as_2d(outputs), _as_2d(targets)
+        mean_x, mean_y = x.mean(axis=0), y.mean(axis=0)
+        dx, dy = x - mean_x, y - mean_y
+        self._combine(len(x), mean_x, mean_y, (dx ** 2).sum(axis=0), (dy ** 2).sum(axis=0), (dx * dy).sum(axis=0))
+
+    def merge(self, other):
+        self._combine(other.n, other.mean_x, other.mean_y, other.m2_x, other.m2_y, other.c_xy)
+        return self
+
+    def compute(self):
+        std_x, std_y = np.sqrt(self.m2_x / self.n), np.sqrt(self.m2_y / self.n)
+        return self.c_xy / self.n / ((std_x + self.eps) * (std_y + self.eps))
+
+
+class PoissonLoss(Accumulator):
+    """
+    Poisson loss (up to the constant term) per unit: sum of `outputs - targets * log(outputs + eps)`.
+
+    Args:
+        avg (bool): if True, the loss is averaged instead of summed over all samples
+        eps (float): added to the outputs before taking the logarithm
+    """
+
+    def __init__(self, avg=False, eps=1e-12):
+        self.avg, self.eps = avg, eps
+        self.n, self.loss = 0, 0.0
+
+    def update(self, outputs, targets):
+        x, y = _as_2d(outputs), _as_2d(targets)
+        self.n += len(x)
+        self.loss = self.loss + (x - y * np.log(x + self.eps)).sum(axis=0)
+
+    def merge(self, other):
+        self.n += other.n
+        self.loss = self.loss + other.loss
+        return self
+
+    def compute(self):
+        return self.loss / self.n if self.avg else self.loss
+
+
+class ExplainedVariance(Accumulator):
+    """Fraction of the variance of the targets explained by the outputs per unit: 1 - Var(targets - outputs) / Var(targets)."""
+
+    def __init__(self):
+        self.residuals, self.targets = Moments(ddof=0), Moments(ddof=0)
+
+    def update(self, outputs, targets):
+        self.residuals.add(_as_2d(targets) - _as_2d(outputs))
+        self.targets.add(targets)
+
+    def merge(self, other):
+        self.residuals.merge(other.residuals)
+        self.targets.merge(other.targets)
+        return self
+
+    def compute(self):
+        return 1 - self.residuals.compute() / self.targets.compute()
+
+
+class ExplainableVariance(Accumulator):
+    """
+    Fraction of explainable variance of the targets per unit, i.e. the fraction of the total variance that is not
+    trial-to-trial variability. Every batch has to contain the repeated trials of a single condition, such as
+    the responses to repeated presentations of the same image. Does not need model outputs (e.g. for MeasuresBase).
+    """
+
+    def __init__(self):
+        self.total = Moments(ddof=1)
+        self.n_conditions, self.noise_var = 0, 0.0
+
+    def update(self, outputs, targets):
+        y = _as_2d(targets)
+        self.total.add(y)
+        self.n_conditions += 1
+        self.noise_var = self.noise_var + y.var(axis=0, ddof=1)
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        self.n_conditions += other.n_conditions
+        self.noise_var = self.noise_var + other.noise_var
+        return self
+
+    def explainable_variance(self):
+        total_var = self.total.compute()
+        return total_var, total_var - self.noise_var / self.n_conditions
+
+    def compute(self):
+        total_var, explainable_var = self.explainable_variance()
+        return explainable_var / total_var
+
+
+class FEV(ExplainableVariance):
+    """
+    Fraction of explainable variance explained (FEVe) by the outputs per unit. As for ExplainableVariance,
+    every batch has to contain the repeated trials of a single condition.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.n, self.squared_error = 0, 0.0
+
+    def update(self, outputs, targets):
+        super().update(outputs, targets)
+        x, y = _as_2d(outputs), _as_2d(targets)
+        self.n += len(y)
+        self.squared_error = self.squared_error + ((x - y) ** 2).sum(axis=0)
+
+    def merge(self, other):
+        super().merge(other)
+        self.n += other.n
+        self.squared_error = self.squared_error + other.squared_error
+        return self
+
+    def compute(self):
+        _, explainable_var = self.explainable_variance()
+        noise_var = self.noise_var / self.n_conditions
+        return 1 - (self.squared_error / self.n - noise_var) / explainable_var
+
+
+def split_batch(batch):
+    """
+    Splits a batch into the inputs, the targets and all other fields of the batch (e.g. behavior or eye position).
+
+    Args:
+        batch: namedtuple (or dict) whose first two fields are the inputs and the targets, or a plain tuple
+
+    Returns:
+        tuple: inputs, targets and a dictionary of the remaining fields by name (empty for plain tuples)
+    """
+    if isinstance(batch, Mapping):
+        fields = dict(batch)
+    elif hasattr(batch, "_asdict"):
+        fields = batch._asdict()
+    else:
+        return batch[0], batch[1], {}
+    names = list(fields)
+    return fields[names[0]], fields[names[1]], {name: fields[name] for name in names[2:]}
+
+
+def model_outputs(model, dataloaders, device=None):
+    """
+    Runs `model` once over all batches in `dataloaders` and yields the outputs together with the targets.
+
+    Args:
+        model (nn.Module): the model. If `dataloaders` is a dictionary, the model is called with the
+            corresponding `data_key` keyword argument.
+        dataloaders (dict or DataLoader): dictionary of dataloaders (one per data_key), or a single dataloader.
+            Each batch is expected to contain the inputs as first and the targets as second element. All further
+            fields of namedtuple (or dict) batches are passed to the model as keyword arguments.
+        device (str, optional): device to run the model on. Defaults to the device of the model's parameters.
+
+    Yields:
+        tuple: data_key (None for a single dataloader), outputs and targets of a batch, as numpy arrays
+    """
+    if not isinstance(dataloaders, Mapping):
+        dataloaders = {None: dataloaders}
+
+    if device is None:
+        parameter = next(iter(model.parameters()), None)
+        device = parameter.device if parameter is not None else "cpu"
+
+    with eval_state(model), torch.no_grad():
+        for data_key, loader in dataloaders.items():
+            model_kwargs = {} if data_key is None else dict(data_key=data_key)
+            for batch in loader:
+                inputs, targets, fields = split_batch(batch)
+                fields = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in fields.items()}
+                outputs = model(inputs.to(device), **model_kwargs, **fields)
+                yield data_key, to_numpy(outputs), to_numpy(targets)
+
+
+def data_batches(dataloaders):
+    """
+    Yields (data_key, None, targets) for all batches in `dataloaders`, for accumulators of the data alone.
+    See `model_outputs` for the arguments.
+    """
+    if not isinstance(dataloaders, Mapping):
+        dataloaders = {None: dataloaders}
+
+    for data_key, loader in dataloaders.items():
+        for batch in loader:
+            yield data_key, None, to_numpy(split_batch(batch)[1])
+
+
+def accumulate(batches, accumulators):
+    """
+    Feeds a single stream of batches into several accumulators at once. A separate accumulator is created
+    for every data_key, and the unit scores of all data_keys are concatenated in the order of their appearance.
+
+    Args:
+        batches (iterable): (data_key, outputs, targets) tuples, e.g. as yielded by `model_outputs`
+        accumulators (dict): mapping from names to accumulator factories (e.g. Accumulator subclasses)
+
+    Returns:
+        dict: mapping from the names in `accumulators` onto the unit scores (np.array)
+    """
+    per_data_key = OrderedDict()
+    for data_key, outputs, targets in batches:
+        if data_key not in per_data_key:
+            per_data_key[data_key] = {name: factory() for name, factory in accumulators.items()}
+        for accumulator in per_data_key[data_key].values():
+            accumulator.update(outputs, targets)
+
+    return {
+        name: np.concatenate([np.atleast_1d(accs[name].compute()) for accs in per_data_key.values()])
+        if per_data_key
+        else np.array([])
+        for name in accumulators
+    }
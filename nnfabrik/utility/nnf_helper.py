@@ -1,6 +1,17 @@
+import os
+import sys
+import threading
+import warnings
+from concurrent.futures import Future
+from collections import OrderedDict
+from collections.abc import Mapping
 from importlib import import_module
 import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
 from ..utility.dj_helpers import make_hash, cleanup_numpy_scalar
+from ..utility.storage import file_lock
 
 
 def split_module_name(abs_class_name):
@@ -15,11 +26,126 @@ def dynamic_import(abs_module_path, class_name):
     return target_class
 
 
+def estimate_size(obj, _seen=None):
+    """
+    Estimates the memory (in bytes) held by `obj`. Tensors, numpy arrays and the parameters and buffers of
+    PyTorch modules are counted exactly (tensors sharing the same memory are only counted once), containers are
+    traversed, dataloaders are estimated via their dataset, and all other objects contribute their shallow size.
+
+    Args:
+        obj: object to estimate the size of, e.g. a model or a (dictionary of) dataloader(s)
+
+    Returns:
+        int: estimated size in bytes
+    """
+    if _seen is None:
+        _seen = set()
+
+    if isinstance(obj, torch.Tensor):
+        ptr = (obj.device.type, obj.data_ptr())
+        if obj.data_ptr() and ptr in _seen:
+            return 0
+        _seen.add(ptr)
+        return obj.element_size() * obj.nelement()
+
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, nn.Module):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(estimate_size(t, _seen) for t in tensors)
+    if isinstance(obj, Mapping):
+        return sys.getsizeof(obj) + sum(estimate_size(v, _seen) for v in obj.values())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_size(v, _seen) for v in obj)
+    if isinstance(obj, DataLoader):
+        return estimate_size(obj.dataset, _seen)
+    if hasattr(obj, "tensors"):
+        # e.g. torch.utils.data.TensorDataset
+        return estimate_size(obj.tensors, _seen)
+    return sys.getsizeof(obj)
+
+
+def _load_object(path):
+    """Loads an arbitrary object saved with `torch.save`."""
+    try:
+        return torch.load(path, weights_only=False)
+    except TypeError:
+        # older versions of PyTorch do not know about `weights_only`
+        return torch.load(path)
+
+
 class FabrikCache:
-    def __init__(self, base_table, cache_size_limit=10):
+    """
+    Caches the objects (models, dataloaders) loaded from `base_table`, so that they do not need to be rebuilt
+    for each analysis. The cached object is identified by the primary key of `base_table` together with the
+    keyword arguments of `load`.
+
+    Entries are evicted according to `policy` once either the number of entries exceeds `cache_size_limit`
+    or their estimated memory (see `estimate_size`) exceeds `memory_limit`. With a `spill_dir`, evicted entries
+    are saved to disk and loaded from there on the next request, instead of being rebuilt from scratch.
+    The counters in `stats` report the hits, misses and evictions of the cache.
+
+    The cache is thread-safe. Concurrent requests for the same entry are single-flight: only the first request
+    loads the entry, while all others wait for and share its result (counted as `waits`). With a `shared_dir`,
+    loaded entries are additionally written to a file store that is shared among processes (e.g. the workers of
+    a parallel populate), such that every entry is only built once across all of them. Placing `shared_dir`
+    on a memory-backed file system (e.g. `/dev/shm`) avoids touching the disk altogether. Once the files in
+    `shared_dir` exceed `shared_size_limit`, the least recently used ones are removed.
+
+    Args:
+        base_table: DataJoint table class with a `load_model`, `get_dataloader` or `build_model` method
+        cache_size_limit (int, optional): maximum number of cached entries. If 0, nothing is cached. If None,
+            the number of entries is not limited. Defaults to 10.
+        memory_limit (int, optional): maximum estimated memory of all cached entries in bytes. The most recent entry
+            is always kept, even if it exceeds the limit on its own. Defaults to None, i.e. no limit.
+        policy (str, optional): eviction policy, either "lru" (least recently used) or "lfu" (least frequently used,
+            ties are broken by recency). Defaults to "lru".
+        spill_dir (str, optional): directory to save evicted entries to. Entries that can not be pickled are dropped.
+        shared_dir (str, optional): directory of a file store shared with other processes. Every entry built by any of
+            the processes is saved there and loaded by the others instead of being built again.
+        shared_size_limit (int, optional): maximum total size of the files in `shared_dir` in bytes. Defaults to
+            `memory_limit`, as `shared_dir` is typically memory-backed. If both are None, the store is not limited.
+    """
+
+    policies = ("lru", "lfu")
+
+    def __init__(
+        self,
+        base_table,
+        cache_size_limit=10,
+        memory_limit=None,
+        policy="lru",
+        spill_dir=None,
+        shared_dir=None,
+        shared_size_limit=None,
+    ):
+        if policy not in self.policies:
+            raise ValueError("Unknown cache policy `{}`. Choose one of {}".format(policy, ", ".join(self.policies)))
+
         self.base_table = base_table
         self.cache_size_limit = cache_size_limit
-        self.cache = dict()
+        self.memory_limit = memory_limit
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.shared_dir = shared_dir
+        self.shared_size_limit = memory_limit if shared_size_limit is None else shared_size_limit
+        for directory in (self.spill_dir, self.shared_dir):
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+
+        self.cache = OrderedDict()
+        self._sizes = {}
+        self._counts = {}
+        self._lock = threading.RLock()
+        self._pending = {}
+        # events of the evicted entries that are still being written to `spill_dir`, set once the file is complete
+        self._spilling = {}
+        self.stats = dict(hits=0, misses=0, waits=0, evictions=0, spills=0, spill_hits=0, shared_hits=0, shared_evictions=0)
+
         if hasattr(self.base_table, "load_model"):
             self.load_function = self.base_table().load_model
         elif hasattr(self.base_table, "get_dataloader"):
@@ -29,30 +155,230 @@ class FabrikCache:
         else:
             raise ValueError("Base table needs to have a 'load_model', 'get_dataloader', or 'build_model' method")
 
+    @property
+    def memory_usage(self):
+        """Estimated memory of all cached entries in bytes."""
+        return sum(self._sizes.values())
+
     def load(self, key, **kwargs):
         if self.cache_size_limit == 0:
             return self._load_model(key, **kwargs)
-        if not self._is_cached(key):
-            self._cache_model(key, **kwargs)
-        return self._get_cached_model(key)
+
+        cache_key = self._hash_trained_model_key(key, **kwargs)
+        with self._lock:
+            if cache_key in self.cache:
+                self.stats["hits"] += 1
+                self._touch(cache_key)
+                return self.cache[cache_key]
+            future = self._pending.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                self.stats["misses"] += 1
+                future = self._pending[cache_key] = Future()
+            else:
+                self.stats["waits"] += 1
+
+        if not is_owner:
+            # another thread is already loading this entry, so wait for its result
+            return future.result()
+
+        try:
+            obj = self._fetch(cache_key, key, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._pending[cache_key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            evicted = self._insert(cache_key, obj)
+            del self._pending[cache_key]
+        future.set_result(obj)
+
+        for evicted_key, evicted_obj in evicted:
+            self._spill(evicted_key, evicted_obj)
+        return obj
 
     def _load_model(self, key, **kwargs):
         return self.load_function(key=key, **kwargs)
 
-    def _is_cached(self, key):
-        if self._hash_trained_model_key(key) in self.cache:
+    def _is_cached(self, key, **kwargs):
+        return self._hash_trained_model_key(key, **kwargs) in self.cache
+
+    def _touch(self, cache_key):
+        self.cache.move_to_end(cache_key)
+        self._counts[cache_key] += 1
+
+    def _fetch(self, cache_key, key, **kwargs):
+        """
+        Retrieves the entry that is not in memory: from the spill directory, the shared directory, or by
+        loading it from the base table, in that order. Loads of the same entry in several processes
+        sharing `shared_dir` are serialized, so that only one of them actually builds it.
+        """
+        obj = self._load_spilled(cache_key)
+        if obj is not None:
+            return obj
+
+        if self.shared_dir is None:
+            return self._load_model(key, **kwargs)
+
+        path = os.path.join(self.shared_dir, cache_key + ".pt")
+        obj = self._load_shared(path)
+        if obj is None:
+            with file_lock(path + ".lock"):
+                # another process may have stored the entry while waiting for the lock
+                obj = self._load_shared(path)
+                if obj is None:
+                    obj = self._load_model(key, **kwargs)
+                    self._save_shared(path, obj)
+                    self._evict_shared(keep=path)
+        return obj
+
+    def _insert(self, cache_key, obj):
+        """
+        Inserts an entry and makes sure the cache is not bigger than the specified limits.
+        Must be called while holding the lock. Returns the list of evicted (cache key, object) tuples.
+        """
+        self.cache[cache_key] = obj
+        self._sizes[cache_key] = estimate_size(obj) if self.memory_limit is not None else 0
+        self._counts[cache_key] = 1
+        return self._evict()
+
+    def _get_cached_model(self, key, **kwargs):
+        return self.cache[self._hash_trained_model_key(key, **kwargs)]
+
+    def _over_limit(self):
+        if self.cache_size_limit is not None and len(self.cache) > self.cache_size_limit:
             return True
-        return False
+        return self.memory_limit is not None and self.memory_usage > self.memory_limit
+
+    def _evict(self):
+        evicted = []
+        while len(self.cache) > 1 and self._over_limit():
+            if self.policy == "lfu":
+                # candidates are ordered from least to most recently used, so ties go to the least recent
+                candidates = list(self.cache)[:-1]
+                cache_key = min(candidates, key=lambda k: self._counts[k])
+            else:
+                cache_key = next(iter(self.cache))
+            evicted.append((cache_key, self.cache.pop(cache_key)))
+            if self.spill_dir is not None:
+                self._spilling[cache_key] = threading.Event()
+            del self._sizes[cache_key]
+            del self._counts[cache_key]
+            self.stats["evictions"] += 1
+        return evicted
+
+    def _spill_path(self, cache_key):
+        return os.path.join(self.spill_dir, cache_key + ".pt")
+
+    def _spill(self, cache_key, obj):
+        if self.spill_dir is None:
+            return
+        path = self._spill_path(cache_key)
+        # write to a temporary file first, so that the entry is never loaded from a partially written file
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            torch.save(obj, temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            warnings.warn("Evicted cache entry could not be saved to disk and is dropped: {}".format(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        else:
+            with self._lock:
+                self.stats["spills"] += 1
+        finally:
+            with self._lock:
+                self._spilling.pop(cache_key).set()
+
+    def _load_spilled(self, cache_key):
+        if self.spill_dir is None:
+            return None
+        with self._lock:
+            spilling = self._spilling.get(cache_key)
+        if spilling is not None:
+            # the entry was evicted by another thread, which is still writing it to disk
+            spilling.wait()
+        path = self._spill_path(cache_key)
+        if not os.path.exists(path):
+            return None
+        obj = _load_object(path)
+        os.remove(path)
+        with self._lock:
+            self.stats["spill_hits"] += 1
+        return obj
+
+    def _load_shared(self, path):
+        try:
+            obj = _load_object(path)
+            # marks the entry as recently used for `_evict_shared`
+            os.utime(path)
+        except FileNotFoundError:
+            # not stored yet, or removed by another process
+            return None
+        with self._lock:
+            self.stats["shared_hits"] += 1
+        return obj
+
+    def _save_shared(self, path, obj):
+        # write to a temporary file first, so that other processes never see a partially written entry
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            torch.save(obj, temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            warnings.warn("Cache entry could not be saved to the shared directory: {}".format(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _evict_shared(self, keep=None):
+        """
+        Removes the least recently used files from `shared_dir` until their total size is below `shared_size_limit`.
+        The file `keep` is never removed. Processes that already opened a removed file can still read it.
+        """
+        if self.shared_size_limit is None:
+            return
+        with file_lock(os.path.join(self.shared_dir, ".evict.lock")):
+            entries = []
+            for name in os.listdir(self.shared_dir):
+                path = os.path.join(self.shared_dir, name)
+                if not name.endswith(".pt"):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
 
-    def _cache_model(self, key, **kwargs):
-        """Caches a model and makes sure the cache is not bigger than the specified limit."""
-        self.cache[self._hash_trained_model_key(key)] = self._load_model(key, **kwargs)
-        if len(self.cache) > self.cache_size_limit:
-            del self.cache[list(self.cache)[0]]
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.shared_size_limit:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                with self._lock:
+                    self.stats["shared_evictions"] += 1
 
-    def _get_cached_model(self, key):
-        return self.cache[self._hash_trained_model_key(key)]
+    def clear(self):
+        """Removes all entries from the in-memory cache."""
+        with self._lock:
+            self.cache.clear()
+            self._sizes.clear()
+            self._counts.clear()
 
-    def _hash_trained_model_key(self, key):
-        """Creates a hash from the part of the key corresponding to the primary key of the trained model table."""
-        return make_hash({k: key[k] for k in self.base_table().primary_key})
+    def _hash_trained_model_key(self, key, **kwargs):
+        """
+        Creates a hash from the part of the key corresponding to the primary key of the trained model table,
+        and the keyword arguments of the load function (e.g. whether the state_dict is included).
+        """
+        primary_key = {k: key[k] for k in self.base_table().primary_key}
+        if not kwargs:
+            return make_hash(primary_key)
+        return make_hash(dict(key=primary_key, kwargs=kwargs))
@@ -0,0 +1,203 @@
+# helper functions for populating DataJoint tables with multiple worker processes
+
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import datajoint as dj
+
+
+# environment variables read by the BLAS/OpenMP backends when they spin up their thread pools
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def _init_worker(threads_per_worker, config=None):
+    """
+    Initializer for every worker process. Applies the DataJoint configuration of the parent process, caps the number
+    of threads that PyTorch (and the underlying BLAS libraries) may use, and makes sure the worker talks to the
+    database over its own connection.
+
+    Args:
+        threads_per_worker (int): maximal number of threads, or None to leave the thread counts untouched
+        config (dict, optional): snapshot of `dj.config` in the parent process (see `worker_config`)
+    """
+    # spawned workers start from the config files, and would miss all changes made at runtime (e.g. the database
+    # host, stores or `nnfabrik.schema_name`), which have to be applied before any schema is imported
+    if config is not None:
+        dj.config.update(config)
+
+    if threads_per_worker is not None:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(threads_per_worker)
+        import torch
+
+        torch.set_num_threads(threads_per_worker)
+
+    # a connection inherited from the parent process must never be shared
+    dj.conn(reset=True)
+
+
+def worker_config():
+    """Returns a snapshot of `dj.config`, to be handed to `_init_worker` of the worker processes."""
+    return dict(dj.config)
+
+
+def _populate_worker(table_class, restrictions, populate_kwargs):
+    """
+    Runs `populate` on a fresh instance of `table_class` inside a worker process.
+    Returns the list of (key, error message) tuples for all keys that failed.
+    """
+    errors = table_class().populate(*restrictions, **populate_kwargs)
+    return list(errors or [])
+
+
+def _reserved_jobs(table):
+    """Returns the number of jobs of `table` that are currently reserved by any worker."""
+    jobs = table.connection.schemas[table.database].jobs
+    return len(jobs & dict(table_name=table.table_name, status="reserved"))
+
+
+def _drain_worker(table_class, restrictions, populate_kwargs, poll_interval):
+    """
+    Populates one key at a time, re-evaluating the `key_source` after every key, until no key is left and no other
+    worker holds a reserved job whose result could add new keys. Returns the list of errors of all failed keys.
+    """
+    table = table_class()
+    errors = []
+    while True:
+        n_entries, n_errors = len(table), len(errors)
+        errors.extend(table.populate(*restrictions, max_calls=1, **populate_kwargs) or [])
+        if len(table) > n_entries or len(errors) > n_errors:
+            continue
+        if not _reserved_jobs(table):
+            return errors
+        time.sleep(poll_interval)
+
+
+def default_n_workers(threads_per_worker=None):
+    """Returns the number of available CPUs divided by `threads_per_worker`, i.e. the default number of workers."""
+    return max(1, (os.cpu_count() or 1) // (threads_per_worker or 1))
+
+
+def worker_pool(n_workers=None, threads_per_worker=None, start_method="spawn"):
+    """
+    Returns a ProcessPoolExecutor whose worker processes are set up to populate tables: they use the DataJoint config
+    of this process, their own database connection, and at most `threads_per_worker` threads.
+    Tables and functions handed to the workers must be importable by their module path.
+
+    Args:
+        n_workers, threads_per_worker, start_method: see `parallel_populate`
+    """
+    if n_workers is None:
+        n_workers = default_n_workers(threads_per_worker)
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context(start_method),
+        initializer=_init_worker,
+        initargs=(threads_per_worker, worker_config()),
+    )
+
+
+def _run_workers(worker, worker_args, n_workers, threads_per_worker, start_method):
+    """Runs `worker(*worker_args)` in `n_workers` processes and returns the concatenated results."""
+    if n_workers is None:
+        n_workers = default_n_workers(threads_per_worker)
+
+    results = []
+    with worker_pool(n_workers, threads_per_worker, start_method) as executor:
+        futures = [executor.submit(worker, *worker_args) for _ in range(n_workers)]
+        for future in as_completed(futures):
+            results.extend(future.result())
+
+    return results
+
+
+def _worker_populate_kwargs(populate_kwargs):
+    populate_kwargs.setdefault("reserve_jobs", True)
+    populate_kwargs.setdefault("suppress_errors", True)
+    populate_kwargs.setdefault("order", "random")
+    # exception objects can not reliably be sent back from the worker processes
+    populate_kwargs["return_exception_objects"] = False
+    return populate_kwargs
+
+
+def parallel_populate(
+    table,
+    *restrictions,
+    n_workers=None,
+    threads_per_worker=None,
+    start_method="spawn",
+    **populate_kwargs
+):
+    """
+    Populates `table` with `n_workers` worker processes running side by side. Every worker calls `populate`
+    with DataJoint's job reservation enabled, so that each key in the `key_source` is only ever made by a
+    single worker. Failing keys are collected instead of interrupting the whole run.
+
+    The table class must be importable by its module path (i.e. not defined inside `__main__` or a notebook)
+    so that it can be handed over to the worker processes. The same holds true for all restrictions.
+    The schema of the table has to have a jobs table, which DataJoint creates automatically on first use.
+
+    Args:
+        table: DataJoint table class (or instance) to populate
+        restrictions: restrictions passed on to `populate` of every worker
+        n_workers (int, optional): number of worker processes. Defaults to the number of available CPUs
+            divided by `threads_per_worker`.
+        threads_per_worker (int, optional): number of threads each worker may use for PyTorch and BLAS operations.
+            If None, the thread counts are left untouched, which usually leads to an oversubscribed machine.
+        start_method (str, optional): multiprocessing start method. Defaults to "spawn", which is the only
+            method that is safe to use once PyTorch has been initialized in the parent process.
+        populate_kwargs: additional keyword arguments for `populate`. By default, jobs are reserved, errors are
+            suppressed and keys are processed in random order to reduce contention among the workers.
+
+    Returns:
+        list: (key, error message) tuples of all keys that failed in any of the workers.
+    """
+    table_class = table if isinstance(table, type) else table.__class__
+    return _run_workers(
+        _populate_worker,
+        (table_class, restrictions, _worker_populate_kwargs(populate_kwargs)),
+        n_workers,
+        threads_per_worker,
+        start_method,
+    )
+
+
+def drain_populate(
+    table,
+    *restrictions,
+    n_workers=None,
+    threads_per_worker=None,
+    start_method="spawn",
+    poll_interval=10,
+    **populate_kwargs
+):
+    """
+    Populates `table` like `parallel_populate`, but for tables whose `key_source` grows as the table is populated,
+    e.g. because keys depend on other entries of the same table. Every worker populates a single key at a time and
+    re-evaluates the `key_source` after each one, so that new keys are picked up as soon as they become available.
+    Workers that run out of keys wait as long as other workers still hold reserved jobs, and stop once no key is
+    left and no job is reserved.
+
+    Note that jobs reserved by workers that were killed stay reserved, and have to be removed from the jobs table
+    for idle workers to stop.
+
+    Args:
+        table: DataJoint table class (or instance) to populate
+        restrictions: restrictions passed on to `populate` of every worker
+        n_workers, threads_per_worker, start_method: see `parallel_populate`
+        poll_interval (float, optional): seconds an idle worker waits before looking for new keys again
+        populate_kwargs: additional keyword arguments for `populate`, with the same defaults as for `parallel_populate`
+
+    Returns:
+        list: (key, error message) tuples of all keys that failed in any of the workers.
+    """
+    table_class = table if isinstance(table, type) else table.__class__
+    return _run_workers(
+        _drain_worker,
+        (table_class, restrictions, _worker_populate_kwargs(populate_kwargs), poll_interval),
+        n_workers,
+        threads_per_worker,
+        start_method,
+    )
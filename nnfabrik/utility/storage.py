@@ -0,0 +1,734 @@
+# helper functions for storing and loading the state of trained models
+
+import os
+import json
+import hashlib
+import shutil
+import struct
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import datajoint as dj
+
+try:
+    import fcntl
+except ImportError:
+    # file locks are not available (e.g. on Windows), concurrent access is then only protected by atomic renames
+    fcntl = None
+
+
+# file name suffixes of the supported state_dict formats
+STATE_DICT_FORMATS = {"torch": ".pth.tar", "flat": ".flat"}
+
+# dtypes that floating point tensors can be stored in to save space
+STATE_DICT_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+# file name suffixes of the supported compressions, appended to the suffix of the state_dict format.
+# zstd and lz4 require the `zstandard` and `lz4` packages, gzip is always available.
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4"}
+
+# file name suffix of manifests, i.e. of state_dicts whose tensors are kept in a tensor store table
+MANIFEST_SUFFIX = ".manifest"
+
+# magic bytes at the beginning of every file in the flat format
+FLAT_MAGIC = b"NNFFLAT1"
+
+# offsets of all tensors in the flat format are aligned to this number of bytes
+FLAT_ALIGNMENT = 64
+
+
+def _tensor_to_numpy(tensor):
+    """
+    Returns the data of `tensor` as a contiguous numpy array on the CPU. Tensors of dtypes that
+    numpy does not know (i.e. bfloat16) are reinterpreted as integers of the same width.
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype is torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def save_flat_state_dict(state_dict, filepath):
+    """
+    Saves `state_dict` into a flat file which can be memory-mapped by `load_flat_state_dict`.
+
+    The file starts with the magic bytes, followed by the length of the header (8 bytes, little endian) and
+    the header itself, a JSON object that maps the name of every tensor onto its dtype, shape and the location
+    of its data. The raw data of all tensors follows after the header, each aligned to `FLAT_ALIGNMENT` bytes.
+
+    Args:
+        state_dict (dict): mapping from names to tensors, e.g. the result of `model.state_dict()`
+        filepath (str): path of the file to write
+    """
+    arrays = OrderedDict()
+    index = OrderedDict()
+    offset = 0
+    for name, tensor in state_dict.items():
+        if not isinstance(tensor, torch.Tensor):
+            raise ValueError(
+                "The flat state_dict format only supports tensors, but `{}` is of type {}".format(name, type(tensor))
+            )
+        arr = _tensor_to_numpy(tensor)
+        offset = -(-offset // FLAT_ALIGNMENT) * FLAT_ALIGNMENT
+        index[name] = dict(
+            dtype=str(tensor.dtype), format=arr.dtype.str, shape=list(arr.shape), offset=offset, nbytes=arr.nbytes
+        )
+        arrays[name] = arr
+        offset += arr.nbytes
+
+    header = dict(
+        tensors=index,
+        metadata=getattr(state_dict, "_metadata", None),
+        original_dtypes=getattr(state_dict, "_original_dtypes", None),
+    )
+    header = json.dumps(header).encode()
+    data_start = -(-(len(FLAT_MAGIC) + 8 + len(header)) // FLAT_ALIGNMENT) * FLAT_ALIGNMENT
+
+    with open(filepath, "wb") as f:
+        f.write(FLAT_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.seek(data_start + index[name]["offset"])
+            f.write(arr.reshape(-1).view(np.uint8))
+        f.truncate(data_start + offset)
+
+
+def read_flat_header(filepath):
+    """
+    Reads the header of a flat state_dict file.
+
+    Returns:
+        tuple: the header (dict) and the position of the first data byte in the file
+    """
+    with open(filepath, "rb") as f:
+        magic = f.read(len(FLAT_MAGIC))
+        if magic != FLAT_MAGIC:
+            raise ValueError("{} is not a flat state_dict file".format(filepath))
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode())
+    data_start = -(-(len(FLAT_MAGIC) + 8 + header_length) // FLAT_ALIGNMENT) * FLAT_ALIGNMENT
+    return header, data_start
+
+
+class LazyStateDict(Mapping):
+    """
+    Read-only state_dict backed by a memory-mapped file in the flat format. Tensors are only created when
+    they are accessed, and share their memory with the mapped file, so that no data is read from disk before
+    `load_state_dict` actually copies it into the parameters of a model.
+
+    Args:
+        filepath (str): path of the flat state_dict file
+        cleanup_dir (str, optional): directory that is removed once the mapped file is no longer in use,
+            i.e. after this object and all tensors created from it have been garbage collected.
+    """
+
+    def __init__(self, filepath, cleanup_dir=None):
+        self.filepath = filepath
+        header, data_start = read_flat_header(filepath)
+        self._index = header["tensors"]
+        self._metadata = header.get("metadata")
+        self._original_dtypes = header.get("original_dtypes") or {}
+
+        total = data_start + max([e["offset"] + e["nbytes"] for e in self._index.values()] + [0])
+        # copy-on-write mapping, so that the resulting tensors are writable without touching the file
+        self._buffer = np.memmap(filepath, dtype=np.uint8, mode="c", shape=(total,)) if total > data_start else None
+        self._data_start = data_start
+
+        if cleanup_dir is not None:
+            owner = self._buffer if self._buffer is not None else self
+            weakref.finalize(owner, shutil.rmtree, cleanup_dir, True)
+
+    def __getitem__(self, name):
+        entry = self._index[name]
+        start = self._data_start + entry["offset"]
+        if entry["nbytes"]:
+            arr = self._buffer[start : start + entry["nbytes"]].view(np.dtype(entry["format"]))
+        else:
+            arr = np.empty(0, dtype=np.dtype(entry["format"]))
+        tensor = torch.from_numpy(arr.reshape(entry["shape"]))
+        dtype = getattr(torch, entry["dtype"].split(".")[-1])
+        if tensor.dtype is not dtype:
+            tensor = tensor.view(dtype)
+        if name in self._original_dtypes:
+            # stored at reduced precision, the upcast copies the tensor into memory
+            tensor = tensor.to(_torch_dtype(self._original_dtypes[name]))
+        return tensor
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def nbytes(self, name):
+        """Returns the size of the stored tensor `name` in bytes, without accessing its data."""
+        return self._index[name]["nbytes"]
+
+    def copy(self):
+        """Materializes all tensors (still backed by the mapped file) into an OrderedDict."""
+        state_dict = OrderedDict(self.items())
+        if self._metadata is not None:
+            state_dict._metadata = self._metadata
+        return state_dict
+
+
+def load_flat_state_dict(filepath, cleanup_dir=None):
+    """
+    Memory-maps a state_dict saved with `save_flat_state_dict`. See `LazyStateDict` for details.
+    """
+    return LazyStateDict(filepath, cleanup_dir=cleanup_dir)
+
+
+def _torch_dtype(name):
+    """Returns the torch dtype of the given name, e.g. "torch.float32" or "float32"."""
+    return getattr(torch, name.split(".")[-1])
+
+
+def cast_state_dict(state_dict, dtype):
+    """
+    Returns a copy of `state_dict` with all floating point tensors of higher precision cast to `dtype`.
+    The original dtypes are kept in the `_original_dtypes` attribute of the copy, and are restored by
+    `restore_dtypes` (which `load_state_dict_file` does on its own).
+
+    Args:
+        state_dict (dict): mapping from names to tensors
+        dtype (str): one of STATE_DICT_DTYPES, i.e. "float16" or "bfloat16"
+    """
+    if dtype not in STATE_DICT_DTYPES:
+        raise ValueError("Unknown state_dict dtype `{}`. Choose one of {}".format(dtype, ", ".join(STATE_DICT_DTYPES)))
+    target = STATE_DICT_DTYPES[dtype]
+    target_size = torch.empty(0, dtype=target).element_size()
+
+    cast = OrderedDict()
+    original_dtypes = {}
+    for name, value in state_dict.items():
+        if (
+            isinstance(value, torch.Tensor)
+            and value.is_floating_point()
+            and value.dtype is not target
+            and value.element_size() > target_size
+        ):
+            original_dtypes[name] = str(value.dtype)
+            value = value.to(target)
+        cast[name] = value
+    if getattr(state_dict, "_metadata", None) is not None:
+        cast._metadata = state_dict._metadata
+    cast._original_dtypes = original_dtypes
+    return cast
+
+
+def restore_dtypes(state_dict):
+    """Casts the tensors of a state_dict saved with `cast_state_dict` back to their original dtypes."""
+    original_dtypes = getattr(state_dict, "_original_dtypes", None)
+    if not original_dtypes:
+        return state_dict
+
+    restored = OrderedDict(
+        (name, value.to(_torch_dtype(original_dtypes[name])) if name in original_dtypes else value)
+        for name, value in state_dict.items()
+    )
+    if getattr(state_dict, "_metadata", None) is not None:
+        restored._metadata = state_dict._metadata
+    return restored
+
+
+def _check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            "Unknown compression `{}`. Choose one of {}".format(compression, ", ".join(COMPRESSIONS))
+        )
+
+
+def _open_compressed(filepath, compression, mode):
+    """Opens `filepath` for streamed (de)compression in binary `mode` ("rb" or "wb")."""
+    _check_compression(compression)
+    if compression == "gzip":
+        import gzip
+
+        return gzip.open(filepath, mode, compresslevel=6)
+    if compression == "lz4":
+        import lz4.frame
+
+        return lz4.frame.open(filepath, mode)
+
+    import zstandard
+
+    f = open(filepath, mode)
+    if mode == "wb":
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+    return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+
+
+def compress_file(source, target, compression):
+    """Compresses the file `source` into the file `target`."""
+    with open(source, "rb") as fin, _open_compressed(target, compression, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+def decompress_file(source, target, compression):
+    """Decompresses the file `source` into the file `target`."""
+    with _open_compressed(source, compression, "rb") as fin, open(target, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+def file_compression(filepath):
+    """Returns the compression of a state_dict file inferred from its name, or None if it is not compressed."""
+    for compression, suffix in COMPRESSIONS.items():
+        if str(filepath).endswith(suffix):
+            return compression
+    return None
+
+
+def state_dict_filename(name, format="torch", compression=None):
+    """
+    Returns the file name for a state_dict named `name` saved in the given `format` and `compression`.
+    """
+    if format not in STATE_DICT_FORMATS:
+        raise ValueError(
+            "Unknown state_dict format `{}`. Choose one of {}".format(format, ", ".join(STATE_DICT_FORMATS))
+        )
+    filename = name + STATE_DICT_FORMATS[format]
+    if compression is not None:
+        _check_compression(compression)
+        filename += COMPRESSIONS[compression]
+    return filename
+
+
+def save_state_dict_file(state_dict, filepath, format="torch", dtype=None, compression=None):
+    """
+    Saves `state_dict` to `filepath` in the given `format`, which is either "torch" (i.e. `torch.save`)
+    or "flat" (see `save_flat_state_dict`).
+
+    Args:
+        state_dict (dict): mapping from names to tensors
+        filepath (str): path of the file to write, named as returned by `state_dict_filename`
+        format (str): "torch" or "flat"
+        dtype (str, optional): if given, floating point tensors are stored at this reduced precision
+            (see `cast_state_dict`), and cast back to their original dtypes when loaded
+        compression (str, optional): one of COMPRESSIONS. The file is compressed as a whole, after it was written.
+    """
+    if format not in STATE_DICT_FORMATS:
+        raise ValueError(
+            "Unknown state_dict format `{}`. Choose one of {}".format(format, ", ".join(STATE_DICT_FORMATS))
+        )
+    if dtype is not None:
+        state_dict = cast_state_dict(state_dict, dtype)
+
+    if compression is not None:
+        _check_compression(compression)
+        raw_filepath = filepath + ".raw"
+        try:
+            save_state_dict_file(state_dict, raw_filepath, format=format)
+            compress_file(raw_filepath, filepath, compression)
+        finally:
+            if os.path.exists(raw_filepath):
+                os.remove(raw_filepath)
+    elif format == "torch":
+        torch.save(state_dict, filepath)
+    else:
+        save_flat_state_dict(state_dict, filepath)
+
+
+def load_state_dict_file(filepath, cleanup_dir=None):
+    """
+    Loads a state_dict saved with `save_state_dict_file`. Format and compression are inferred from the file name.
+    Compressed files are decompressed into a temporary directory first. Files in the flat format are memory-mapped
+    and returned as `LazyStateDict`, all other files are loaded with `torch.load`. Tensors stored at reduced precision
+    are cast back to their original dtypes.
+
+    Args:
+        filepath (str): path of the state_dict file
+        cleanup_dir (str, optional): directory to remove once the state_dict is loaded. For memory-mapped files,
+            this happens only when the mapping is no longer in use.
+    """
+    compression = file_compression(filepath)
+    if compression is not None:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw_filepath = os.path.join(temp_dir, os.path.basename(filepath)[: -len(COMPRESSIONS[compression])])
+            decompress_file(filepath, raw_filepath, compression)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        finally:
+            if cleanup_dir is not None:
+                shutil.rmtree(cleanup_dir, ignore_errors=True)
+        return load_state_dict_file(raw_filepath, cleanup_dir=temp_dir)
+
+    if str(filepath).endswith(STATE_DICT_FORMATS["flat"]):
+        return load_flat_state_dict(filepath, cleanup_dir=cleanup_dir)
+
+    state_dict = torch.load(filepath)
+    if cleanup_dir is not None:
+        shutil.rmtree(cleanup_dir, ignore_errors=True)
+    return restore_dtypes(state_dict)
+
+
+def tensor_digest(dtype, array):
+    """
+    Returns the MD5 hash (hex string) of a tensor given its dtype (str) and its data as numpy array
+    (see `_tensor_to_numpy`). Tensors with equal dtype, shape and data have the same digest.
+    """
+    digest = hashlib.md5()
+    digest.update(dtype.encode())
+    digest.update(str(tuple(array.shape)).encode())
+    digest.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _digest_restriction(digests):
+    return [dict(tensor_digest=digest) for digest in sorted(digests)]
+
+
+def store_tensors(table, state_dict):
+    """
+    Stores the tensors of `state_dict` in the tensor store `table` (see templates.TensorStoreBase), and returns the
+    manifest of the state_dict, which refers to the tensors by their digests. Every distinct tensor is stored only
+    once: the digests that are already stored are found with a single query, and only the other tensors are uploaded.
+    The data of every tensor is stored as raw bytes, since DataJoint blobs do not support all dtypes (e.g. float16).
+
+    Returns:
+        dict: the manifest, to be saved with `save_manifest`
+    """
+    digests, objects, arrays = OrderedDict(), OrderedDict(), OrderedDict()
+    for name, value in state_dict.items():
+        if isinstance(value, torch.Tensor):
+            dtype, array = str(value.dtype), _tensor_to_numpy(value)
+            digest = tensor_digest(dtype, array)
+            digests[name] = digest
+            arrays[digest] = (dtype, array)
+        else:
+            objects[name] = value
+
+    if arrays:
+        stored = set((table & _digest_restriction(arrays)).fetch("tensor_digest"))
+        table.insert(
+            [
+                dict(
+                    tensor_digest=digest,
+                    tensor_dtype=dtype,
+                    tensor_shape=list(array.shape),
+                    tensor_nbytes=array.nbytes,
+                    tensor_data=array.reshape(-1).view(np.uint8),
+                )
+                for digest, (dtype, array) in arrays.items()
+                if digest not in stored
+            ],
+            skip_duplicates=True,
+        )
+
+    return dict(
+        names=list(state_dict),
+        tensors=digests,
+        objects=objects,
+        metadata=getattr(state_dict, "_metadata", None),
+        original_dtypes=getattr(state_dict, "_original_dtypes", None),
+    )
+
+
+def assemble_state_dict(table, manifest):
+    """
+    Assembles the state_dict described by `manifest` (see `store_tensors`) from the tensor store `table`.
+    All tensors are fetched with a single query. Tensors stored at reduced precision are cast back to their
+    original dtypes.
+    """
+    digests = set(manifest["tensors"].values())
+    tensors = {}
+    if digests:
+        rows = (table & _digest_restriction(digests)).fetch("tensor_digest", "tensor_dtype", "tensor_shape", "tensor_data")
+        for digest, dtype, shape, data in zip(*rows):
+            shape, dtype = [int(n) for n in np.ravel(shape)], _torch_dtype(dtype)
+            if data.size == 0:
+                tensors[digest] = torch.empty(shape, dtype=dtype)
+            else:
+                tensors[digest] = torch.frombuffer(bytearray(data), dtype=dtype).reshape(shape)
+
+    missing = digests - set(tensors)
+    if missing:
+        raise ValueError("{} tensors of the state_dict are missing in {}".format(len(missing), table.full_table_name))
+
+    state_dict = OrderedDict(
+        (name, tensors[manifest["tensors"][name]] if name in manifest["tensors"] else manifest["objects"][name])
+        for name in manifest["names"]
+    )
+    if manifest.get("metadata") is not None:
+        state_dict._metadata = manifest["metadata"]
+    state_dict._original_dtypes = manifest.get("original_dtypes")
+    return restore_dtypes(state_dict)
+
+
+def save_manifest(manifest, filepath):
+    """Saves a manifest as returned by `store_tensors` to `filepath`."""
+    torch.save(manifest, filepath)
+
+
+def load_manifest(filepath, cleanup_dir=None):
+    """Loads a manifest saved with `save_manifest`, and removes `cleanup_dir` if given."""
+    try:
+        return torch.load(filepath, weights_only=False)
+    except TypeError:
+        # older versions of PyTorch do not know about `weights_only`
+        return torch.load(filepath)
+    finally:
+        if cleanup_dir is not None:
+            shutil.rmtree(cleanup_dir, ignore_errors=True)
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    Holds a lock on the file `path` (created if necessary) while in the context.
+
+    Args:
+        path (str): path of the lock file
+        shared (bool): if True, the lock is shared with other shared locks, otherwise it is exclusive
+        blocking (bool): if False, the lock is not waited for if it is held by someone else
+
+    Yields:
+        bool: whether the lock was acquired (always True if `blocking`)
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(path, "a") as f:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def attachment_checksum(table, attribute):
+    """
+    Returns the checksum (UUID) that DataJoint stores for the attachment `attribute` of the single entry
+    in `table`, without downloading the attachment itself.
+
+    Args:
+        table: DataJoint table restricted to a single entry
+        attribute (str): name of the attachment attribute
+    """
+    # the projection onto the hex string of the stored UUID keeps DataJoint from downloading the attachment
+    checksums = table.proj(attachment_checksum="HEX({})".format(attribute)).fetch("attachment_checksum")
+    if len(checksums) != 1:
+        raise dj.DataJointError(
+            "Expected a single entry to fetch the attachment from, but found {}".format(len(checksums))
+        )
+    return uuid.UUID(hex=checksums[0])
+
+
+class AttachmentCache:
+    """
+    Persistent, content-addressed on-disk cache for attachments stored in DataJoint tables. Entries are keyed
+    by the checksum of the attachment, so that an attachment is only downloaded from the external store once,
+    and every later fetch is served from the local disk. Once the total size of the cache exceeds `size_limit`,
+    the least recently used entries are evicted.
+
+    The cache can safely be shared by several processes: new entries are downloaded into a temporary directory
+    and moved into place atomically, and downloads of the same attachment as well as evictions are serialized
+    with file locks. Entries that are read within `open` hold a shared lock, and are never evicted meanwhile.
+
+    Args:
+        directory (str, optional): root directory of the cache. Defaults to `dj.config["nnfabrik.attachment_cache"]`,
+            or `~/.cache/nnfabrik/attachments` if that is not set.
+        size_limit (int, optional): maximum total size of the cache in bytes. If None, the cache grows without bound.
+    """
+
+    def __init__(self, directory=None, size_limit=None):
+        if directory is None:
+            directory = dj.config.get(
+                "nnfabrik.attachment_cache", os.path.join(os.path.expanduser("~"), ".cache", "nnfabrik", "attachments")
+            )
+        self.directory = directory
+        self.size_limit = size_limit
+        self._lock_dir = os.path.join(self.directory, ".locks")
+        os.makedirs(self._lock_dir, exist_ok=True)
+
+    def _entry_dir(self, checksum):
+        return os.path.join(self.directory, checksum.hex)
+
+    @staticmethod
+    def _entry_file(entry_dir):
+        names = os.listdir(entry_dir)
+        return os.path.join(entry_dir, names[0]) if names else None
+
+    def _read_lock(self, checksum):
+        return os.path.join(self._lock_dir, checksum.hex + ".read")
+
+    @contextmanager
+    def open(self, table, attribute):
+        """
+        Yields the local path of the attachment `attribute` of the single entry in `table`, like `fetch`, and keeps
+        other processes from evicting the entry until the context is left. The file has to be read (or opened)
+        within the context.
+        """
+        checksum = attachment_checksum(table, attribute)
+        with file_lock(self._read_lock(checksum), shared=True):
+            yield self._fetch(table, attribute, checksum)
+
+    def fetch(self, table, attribute):
+        """
+        Returns the local path of the attachment `attribute` of the single entry in `table`, downloading
+        it into the cache only if it is not already present. If other processes evict entries of the same
+        cache, use `open` instead.
+        """
+        with self.open(table, attribute) as filepath:
+            return filepath
+
+    def _fetch(self, table, attribute, checksum):
+        entry_dir = self._entry_dir(checksum)
+
+        filepath = self._lookup(entry_dir)
+        if filepath is not None:
+            return filepath
+
+        with file_lock(os.path.join(self._lock_dir, checksum.hex)):
+            # another process may have downloaded the attachment while waiting for the lock
+            filepath = self._lookup(entry_dir)
+            if filepath is None:
+                temp_dir = tempfile.mkdtemp(prefix=".download-", dir=self.directory)
+                try:
+                    table.fetch1(attribute, download_path=temp_dir)
+                    try:
+                        os.rename(temp_dir, entry_dir)
+                    except OSError:
+                        # without file locks, another process may have won the race
+                        if not os.path.isdir(entry_dir):
+                            raise
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                filepath = self._entry_file(entry_dir)
+
+        if self.size_limit is not None:
+            self.evict(keep=entry_dir)
+
+        return filepath
+
+    def _lookup(self, entry_dir):
+        """
+        Returns the path of the cached file in `entry_dir` and marks the entry as recently used,
+        or returns None if the entry does not exist.
+        """
+        try:
+            filepath = self._entry_file(entry_dir)
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            return None
+        return filepath
+
+    def entries(self):
+        """
+        Returns a list of (last access time, size in bytes, entry directory) tuples for all cached entries.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except FileNotFoundError:
+                # evicted by another process in the meantime
+                continue
+        return entries
+
+    def size(self):
+        """Returns the total size of all cached entries in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the total size of the cache is below `size_limit`.
+        The entry directory `keep` and entries that are currently read by any process are never removed.
+        """
+        if self.size_limit is None:
+            return
+        with file_lock(os.path.join(self._lock_dir, "evict")):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in entries:
+                if total <= self.size_limit:
+                    break
+                if entry_dir == keep:
+                    continue
+                read_lock = os.path.join(self._lock_dir, os.path.basename(entry_dir) + ".read")
+                with file_lock(read_lock, blocking=False) as unused:
+                    if not unused:
+                        continue
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        with file_lock(os.path.join(self._lock_dir, "evict")):
+            for _, _, entry_dir in self.entries():
+                with file_lock(os.path.join(self._lock_dir, os.path.basename(entry_dir) + ".read")):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+
+
+class UploadQueue:
+    """
+    Runs uploads on a pool of background threads. The number of pending uploads is bounded, so that the memory
+    held by the data waiting to be uploaded is capped: `submit` blocks as long as `max_pending` uploads are pending.
+
+    Args:
+        workers (int): number of upload threads
+        max_pending (int): maximal number of uploads that are queued or running
+    """
+
+    def __init__(self, workers=1, max_pending=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # thread local storage for the upload functions, e.g. for a separate database connection per thread
+        self.local = threading.local()
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedules the upload `fn(*args, **kwargs)` of `key`, and returns its Future."""
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._pending.append((key, future))
+        return future
+
+    def __len__(self):
+        with self._lock:
+            return sum(not future.done() for _, future in self._pending)
+
+    def flush(self):
+        """
+        Waits for all uploads submitted so far.
+
+        Returns:
+            list: (key, exception) tuples of all uploads that failed
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        errors = [(key, future.exception()) for key, future in pending]
+        return [(key, error) for key, error in errors if error is not None]
+
+    def shutdown(self):
+        """Waits for all uploads, and stops the upload threads. Returns the failed uploads as `flush`."""
+        errors = self.flush()
+        self.executor.shutdown(wait=True)
+        return errors
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import torch
+
+from nnfabrik.utility.dj_helpers import clear_hash_cache, make_hash
+
+# digests of the element-wise implementation of previous versions, which existing table entries are keyed by
+COMPAT_HASHES = [
+    (
+        {"lr": 0.001, "layers": [64, 32], "opts": {"momentum": 0.9, "nesterov": True, "schedule": None}},
+        "d501715c41c1678185359c8b5f45ea47",
+    ),
+    (
+        {"opts": {"schedule": None, "nesterov": True, "momentum": 0.9}, "layers": [64, 32], "lr": 0.001},
+        "d501715c41c1678185359c8b5f45ea47",
+    ),
+    (OrderedDict([("b", 1), ("a", 2)]), "c200df6d6fb4467336c21b0d328723b2"),
+    ((1, 2.5, "x"), "471279a1132060bdeecf207ab2086874"),
+    ([1, 2.5, "x"], "471279a1132060bdeecf207ab2086874"),
+    (np.arange(6, dtype=np.int64).reshape(2, 3), "cfacfecc5989fadf2c58001a79be933d"),
+    (np.linspace(0, 1, 4, dtype=np.float32), "04d0f58fc69fe09da8d925ff744127a6"),
+    (-0.0, "e80c77464a0cfaf2c46a5574f6bc76b9"),
+    (0.0, "30565a8911a6bb487e3745c0ea3c8224"),
+    (float("nan"), "a3d2de7675556553a5f08e4c88d2c228"),
+    (True, "f827cf462f62848df37c5e1e94a4da74"),
+    (1, "c4ca4238a0b923820dcc509a6f75849b"),
+    (1.0, "e4c2e8edac362acab7123654b9e73432"),
+    ((-0.0, 0.0, True, 1, 1.0), "bcfe2838353d43d494cb9a19f0c4e2ed"),
+]
+
+BUFFER_HASHES = [
+    (np.arange(6, dtype=np.int64).reshape(2, 3), "3aa05889cb8bcfb51789d835bb164144"),
+    (np.arange(6, dtype=np.int64).reshape(3, 2), "481c12e3e84d4e509bee122586db4b7a"),
+    (torch.arange(4, dtype=torch.bfloat16), "328ea487a438eb67baadef1e2e09ea61"),
+    (torch.arange(4, dtype=torch.float16), "6c68c0738c1dbe68cf2f80dabc839ee4"),
+    ({"w": torch.ones(2, 2), "b": np.zeros(2, dtype=np.float32)}, "1c2646f4f68e892673cc4784e9f7e394"),
+]
+
+
+@pytest.mark.parametrize("obj, expected", COMPAT_HASHES)
+def test_compat_hashes_are_unchanged(obj, expected):
+    clear_hash_cache()
+    assert make_hash(obj, compat=True) == expected
+    # a second time from the digest cache
+    assert make_hash(obj, compat=True) == expected
+
+
+@pytest.mark.parametrize("obj, expected", BUFFER_HASHES)
+def test_buffer_hashes_are_unchanged(obj, expected):
+    clear_hash_cache()
+    assert make_hash(obj, compat=False) == expected
+    assert make_hash(obj, compat=False) == expected
+
+
+def test_buffer_hashes_depend_on_content_not_memory_layout():
+    array = np.arange(6, dtype=np.int64).reshape(3, 2)
+    assert make_hash(array.T, compat=False) == make_hash(np.ascontiguousarray(array.T), compat=False)
+    assert make_hash(array, compat=False) != make_hash(array.reshape(2, 3), compat=False)
+    assert make_hash(torch.ones(2, dtype=torch.bfloat16), compat=False) != make_hash(torch.ones(2), compat=False)
+
+
+def test_objects_without_arrays_hash_identically_in_both_modes():
+    for obj, _ in COMPAT_HASHES:
+        if not isinstance(obj, np.ndarray):
+            assert make_hash(obj, compat=False) == make_hash(obj, compat=True)
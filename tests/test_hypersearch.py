@@ -0,0 +1,85 @@
+import importlib
+import sys
+import threading
+import types
+
+import pytest
+
+from nnfabrik.utility.dj_helpers import make_hash
+
+
+class Connection:
+    def ping(self):
+        pass
+
+
+@pytest.fixture
+def trained_model_base(monkeypatch):
+    """
+    Returns TrainedModelBase, imported against a placeholder of nnfabrik.main, which declares its tables (and hence
+    connects to the database) on import.
+    """
+    main = types.ModuleType("nnfabrik.main")
+    main.Model = main.Dataset = main.Trainer = main.Seed = main.Fabrikant = None
+    main.make_hash = make_hash
+    monkeypatch.setitem(sys.modules, "nnfabrik.main", main)
+    for name in list(sys.modules):
+        if name.startswith("nnfabrik.templates") or name == "nnfabrik.utility.hypersearch":
+            monkeypatch.delitem(sys.modules, name)
+    return importlib.import_module("nnfabrik.templates.trained_model").TrainedModelBase
+
+
+@pytest.fixture
+def key():
+    return dict(
+        dataset_fn="data", dataset_hash="1", model_fn="model", model_hash="2", trainer_fn="trainer", trainer_hash="3"
+    )
+
+
+def make_table(trained_model_base, populate_call_back):
+    class TrainedModel(trained_model_base):
+        connection = Connection()
+
+    table = TrainedModel.__new__(TrainedModel)
+    # as set by `populate(call_back=...)`
+    table._populate_call_back = populate_call_back
+    return table
+
+
+def trainer(scores):
+    """Returns a trainer that calls the callback as documented for ASHA, with the given score per epoch."""
+
+    def train(model, dataloaders, seed, uid, cb):
+        for epoch, score in enumerate(scores, start=1):
+            cb(epoch=epoch, model=model, info=dict(score=score))
+        return scores[-1], None, {}
+
+    return train
+
+
+def test_populate_call_back_receives_the_key(trained_model_base, key):
+    calls = []
+    table = make_table(trained_model_base, lambda **kwargs: calls.append(kwargs))
+
+    table.train(dict(key, seed=0), None, None, trainer([0.5, 0.7]), 0)
+
+    assert [call["uid"] for call in calls] == [dict(key, seed=0)] * 2
+    assert [call["epoch"] for call in calls] == [1, 2]
+
+
+def test_rung_call_back_through_train(trained_model_base, key):
+    pytest.importorskip("ax")
+    from nnfabrik.utility.hypersearch import RungCallBack, TrialStopped
+
+    rung_scores = {(0, 1): [0.8, 0.9]}
+    call_back = RungCallBack(
+        {RungCallBack.trial_hash(key): 0}, [[1, 3]], 3, False, None, rung_scores, threading.Lock()
+    )
+    table = make_table(trained_model_base, call_back)
+
+    assert table.train(dict(key, seed=0), None, None, trainer([1.0, 1.0, 1.0, 1.0]), 0)[0] == 1.0
+    with pytest.raises(TrialStopped) as stopped:
+        table.train(dict(key, seed=1), None, None, trainer([0.1, 0.1, 0.1, 0.1]), 1)
+
+    assert stopped.value.epoch == 1
+    assert rung_scores == {(0, 1): [0.8, 0.9, 1.0, 0.1], (0, 3): [1.0]}
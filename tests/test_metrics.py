@@ -0,0 +1,95 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from nnfabrik.utility import metrics
+
+
+@pytest.fixture
+def conditions():
+    """Repeated trials of 20 conditions (targets) with noisy model outputs, 5 units each."""
+    rng = np.random.default_rng(0)
+    targets, outputs = [], []
+    for _ in range(20):
+        n_repeats = rng.integers(3, 8)
+        mean = rng.random((1, 5)) * 5
+        targets.append(rng.poisson(mean + 1, (n_repeats, 5)).astype(float))
+        outputs.append(np.repeat(mean, n_repeats, axis=0) + rng.random((n_repeats, 5)))
+    return outputs, targets
+
+
+def accumulate_in_shards(accumulator, outputs, targets, n_shards=3):
+    """Accumulates every condition as one batch, spread over `n_shards` accumulators that are merged afterwards."""
+    shards = [accumulator() for _ in range(n_shards)]
+    for i, (x, y) in enumerate(zip(outputs, targets)):
+        shards[i % n_shards].update(x, y)
+    for shard in shards[1:]:
+        shards[0].merge(shard)
+    return shards[0].compute()
+
+
+def test_correlation_matches_full_arrays(conditions):
+    outputs, targets = conditions
+    x, y = np.vstack(outputs), np.vstack(targets)
+    expected = ((x - x.mean(0)) * (y - y.mean(0))).mean(0) / ((x.std(0) + 1e-8) * (y.std(0) + 1e-8))
+    assert np.allclose(accumulate_in_shards(metrics.Correlation, outputs, targets), expected)
+
+
+def test_poisson_loss_matches_full_arrays(conditions):
+    outputs, targets = conditions
+    x, y = np.vstack(outputs), np.vstack(targets)
+    expected = (x - y * np.log(x + 1e-12)).sum(0)
+    assert np.allclose(accumulate_in_shards(metrics.PoissonLoss, outputs, targets), expected)
+
+
+def test_explained_variance_matches_full_arrays(conditions):
+    outputs, targets = conditions
+    x, y = np.vstack(outputs), np.vstack(targets)
+    expected = 1 - np.var(y - x, axis=0) / np.var(y, axis=0)
+    assert np.allclose(accumulate_in_shards(metrics.ExplainedVariance, outputs, targets), expected)
+
+
+def test_explainable_variance_and_fev_match_full_arrays(conditions):
+    outputs, targets = conditions
+    x, y = np.vstack(outputs), np.vstack(targets)
+    total_var = np.var(y, axis=0, ddof=1)
+    noise_var = np.mean([np.var(t, axis=0, ddof=1) for t in targets], axis=0)
+    explainable_var = total_var - noise_var
+
+    fraction = accumulate_in_shards(metrics.ExplainableVariance, outputs, targets)
+    assert np.allclose(fraction, explainable_var / total_var)
+    fev = accumulate_in_shards(metrics.FEV, outputs, targets)
+    assert np.allclose(fev, 1 - (np.mean((x - y) ** 2, axis=0) - noise_var) / explainable_var)
+
+
+def test_accumulate_concatenates_data_keys(conditions):
+    outputs, targets = conditions
+    batches = [("a" if i < 10 else "b", x, y) for i, (x, y) in enumerate(zip(outputs, targets))]
+    scores = metrics.accumulate(batches, dict(correlation=metrics.Correlation))
+    assert scores["correlation"].shape == (10,)
+
+
+Batch = namedtuple("Batch", ["images", "responses", "behavior"])
+
+
+class BehaviorModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(torch.ones(1))
+
+    def forward(self, x, data_key=None, behavior=None):
+        return self.scale * x.sum(dim=1, keepdim=True) + behavior
+
+
+def test_model_outputs_passes_further_batch_fields():
+    images, behavior = torch.randn(4, 3), torch.randn(4, 1)
+    loader = [Batch(images, torch.zeros(4, 1), behavior)]
+
+    (data_key, outputs, targets), = metrics.model_outputs(BehaviorModel(), dict(session=loader))
+
+    assert data_key == "session"
+    assert np.allclose(outputs, (images.sum(dim=1, keepdim=True) + behavior).numpy())
+    assert np.allclose(targets, 0)
@@ -0,0 +1,41 @@
+import threading
+import time
+
+import torch
+
+from nnfabrik.utility import nnf_helper
+
+
+class Models:
+    primary_key = ["model_id"]
+    loaded = []
+
+    def load_model(self, key):
+        self.loaded.append(key["model_id"])
+        return torch.arange(1000) + key["model_id"]
+
+
+def test_entry_is_loaded_from_the_spill_directory_while_being_spilled(tmp_path, monkeypatch):
+    save = torch.save
+
+    def slow_save(obj, path):
+        with open(path, "wb") as f:
+            f.write(b"PK")
+        time.sleep(0.3)
+        save(obj, path)
+
+    monkeypatch.setattr(nnf_helper.torch, "save", slow_save)
+    Models.loaded = []
+    cache = nnf_helper.FabrikCache(Models, cache_size_limit=1, spill_dir=str(tmp_path))
+    cache.load(dict(model_id=1))
+
+    # loading another entry evicts the first one, which is then slowly written to the spill directory
+    thread = threading.Thread(target=cache.load, args=(dict(model_id=2),))
+    thread.start()
+    time.sleep(0.1)
+    model = cache.load(dict(model_id=1))
+    thread.join()
+
+    assert torch.equal(model, torch.arange(1000) + 1)
+    assert Models.loaded == [1, 2]
+    assert cache.stats["spill_hits"] == 1
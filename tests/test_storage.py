@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import torch
+from datajoint import blob
+
+from nnfabrik.utility.storage import assemble_state_dict, cast_state_dict, store_tensors
+
+
+class InMemoryTensorStore:
+    """
+    Stands in for a TensorStoreBase table. The tensor data goes through the DataJoint blob serialization, as it would
+    when inserted into the database, so that data DataJoint can not serialize fails here as well.
+    """
+
+    def __init__(self, rows=None, restriction=None):
+        self.rows = OrderedDict() if rows is None else rows
+        self.restriction = restriction
+
+    def __and__(self, restriction):
+        return InMemoryTensorStore(self.rows, {key["tensor_digest"] for key in restriction})
+
+    def fetch(self, *attributes):
+        rows = [row for digest, row in self.rows.items() if digest in self.restriction]
+        rows = [dict(row, tensor_data=blob.unpack(row["tensor_data"])) for row in rows]
+        if len(attributes) == 1:
+            return np.array([row[attributes[0]] for row in rows])
+        return [[row[attribute] for row in rows] for attribute in attributes]
+
+    def insert(self, rows, skip_duplicates=False):
+        for row in rows:
+            self.rows.setdefault(row["tensor_digest"], dict(row, tensor_data=blob.pack(row["tensor_data"])))
+
+
+@pytest.fixture
+def state_dict():
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.BatchNorm2d(8), torch.nn.Linear(4, 2))
+    return model.state_dict()
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_round_trip(state_dict, dtype):
+    state_dict = OrderedDict((k, v.to(dtype) if v.is_floating_point() else v) for k, v in state_dict.items())
+    table = InMemoryTensorStore()
+
+    restored = assemble_state_dict(table, store_tensors(table, state_dict))
+
+    assert list(restored) == list(state_dict)
+    for name, tensor in state_dict.items():
+        assert restored[name].dtype == tensor.dtype
+        assert restored[name].shape == tensor.shape
+        assert torch.equal(restored[name], tensor)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "bfloat16"])
+def test_round_trip_at_reduced_precision(state_dict, dtype):
+    table = InMemoryTensorStore()
+
+    restored = assemble_state_dict(table, store_tensors(table, cast_state_dict(state_dict, dtype)))
+
+    for name, tensor in state_dict.items():
+        assert restored[name].dtype == tensor.dtype
+        assert torch.allclose(restored[name], tensor, atol=1e-2)
+
+
+def test_identical_tensors_are_stored_once(state_dict):
+    table = InMemoryTensorStore()
+    store_tensors(table, state_dict)
+    n_stored = len(table.rows)
+
+    changed = OrderedDict(state_dict)
+    changed["2.weight"] = changed["2.weight"] + 1
+    store_tensors(table, changed)
+
+    assert len(table.rows) == n_stored + 1